@@ -0,0 +1,18 @@
+class Actions(object):
+    # Bit flags for CharacterComponent.actions
+    JUMP = 1 << 0
+    ATTACK = 1 << 1
+    ATTACK_MOVE = 1 << 2
+    TRACK_ONE = 1 << 3
+    TRACK_TWO = 1 << 4
+    TRACK_THREE = 1 << 5
+    TRACK_FOUR = 1 << 6
+    ABORT_START = 1 << 7
+    ABORT_END = 1 << 8
+
+    TRACKS = [
+        (TRACK_ONE, 'track_one'),
+        (TRACK_TWO, 'track_two'),
+        (TRACK_THREE, 'track_three'),
+        (TRACK_FOUR, 'track_four'),
+    ]
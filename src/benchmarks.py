@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+import argparse
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+import ecs
+
+
+def _report(name, times):
+    times = sorted(times)
+    print('{:<32} mean {:8.3f}ms  median {:8.3f}ms  max {:8.3f}ms'.format(
+        name,
+        sum(times) / len(times) * 1000,
+        times[len(times) // 2] * 1000,
+        times[-1] * 1000,
+    ))
+
+
+class _CompressSystem(ecs.System):
+    # Stands in for Bullet stepping: native work that releases the GIL
+    component_types = []
+
+    def __init__(self, resource, payload):
+        self.writes = (resource,)
+        self.payload = payload
+
+    def update(self, dt, components):
+        zlib.compress(self.payload, 6)
+
+
+class _CompressSystemB(_CompressSystem):
+    pass
+
+
+class _PythonSystem(ecs.System):
+    component_types = []
+    writes = ('PYTHON',)
+
+    def __init__(self, iterations):
+        self.iterations = iterations
+
+    def update(self, dt, components):
+        total = 0
+        for i in range(self.iterations):
+            total += i * i
+
+
+def bench_systems(args):
+    payload = os.urandom(args.payload_kb * 1024)
+
+    # Summed system time says nothing about overlap under the GIL, compare whole ticks instead
+    serial_mean = None
+    for workers in (0, 2, 4):
+        manager = ecs.ECSManager(max_workers=workers)
+        manager.add_system(_CompressSystem('NATIVE_A', payload))
+        manager.add_system(_CompressSystemB('NATIVE_B', payload))
+        manager.add_system(_PythonSystem(args.iterations))
+
+        times = []
+        for _ in range(args.ticks):
+            start = time.perf_counter()
+            manager.update(1 / 60)
+            times.append(time.perf_counter() - start)
+        manager.shutdown()
+
+        mean = sum(times) / len(times)
+        if serial_mean is None:
+            serial_mean = mean
+        _report('{} workers, stages {}'.format(workers, manager.schedule), times)
+        print('{:<32} speedup {:.2f}x'.format('', serial_mean / mean))
+
+
+# Runs in a fresh interpreter so every sample pays the full import cost
+_STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+sys.argv = ['main.py'] + {argv!r}
+import main
+imported = time.perf_counter()
+app = main.Sigurd()
+app.taskMgr.step()
+print(imported - start, time.perf_counter() - start)
+'''
+
+
+def _measure_startup(src, argv):
+    output = subprocess.check_output(
+        [sys.executable, '-c', _STARTUP_SCRIPT.format(argv=argv)],
+        cwd=src,
+        universal_newlines=True,
+    )
+    imports, total = output.strip().splitlines()[-1].split()
+    return float(imports), float(total)
+
+
+def bench_startup(args):
+    # --src points at the src directory of another checkout, to compare startup before and after a change
+    src = os.path.abspath(args.src or os.path.dirname(os.path.abspath(__file__)))
+    port = str(args.port)
+
+    for mode in ('server', 'client', 'stand-alone'):
+        server = None
+        if mode == 'client':
+            server = subprocess.Popen(
+                [sys.executable, 'main.py', 'server', port],
+                cwd=src,
+                stdout=subprocess.DEVNULL,
+            )
+            time.sleep(1)
+
+        try:
+            samples = [_measure_startup(src, [mode, port]) for _ in range(args.runs)]
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+        # Note: stand-alone includes the one second it waits for its server process
+        _report('{} imports'.format(mode), [i[0] for i in samples])
+        _report('{} first frame'.format(mode), [i[1] for i in samples])
+
+
+def bench_lagcomp(args):
+    import random
+    import lagcomp
+
+    rng = random.Random(0)
+    for count in (100, 1000, 5000):
+        history = lagcomp.HitboxHistory(args.history_ticks, (0.25, 0.25, 0.8), (0.0, 0.0, 0.9))
+        positions = {guid: [rng.uniform(-100, 100), rng.uniform(-100, 100), 0.0, rng.uniform(0, 360)] for guid in range(count)}
+        for tick in range(args.history_ticks):
+            for pos in positions.values():
+                pos[0] += rng.uniform(-0.1, 0.1)
+            history.record(tick / 60, {guid: tuple(pos) for guid, pos in positions.items()})
+
+        times = []
+        for _ in range(args.ticks):
+            from_pos = (rng.uniform(-100, 100), rng.uniform(-100, 100), 0.5)
+            to_pos = (from_pos[0] + 20.0, from_pos[1], 0.5)
+            view_time = rng.uniform(0, args.history_ticks / 60)
+            start = time.perf_counter()
+            history.ray_cast(from_pos, to_pos, view_time)
+            times.append(time.perf_counter() - start)
+
+        _report('rewind ray cast, {} hitboxes'.format(count), times)
+
+
+def bench_snapshot_apply(args):
+    # Client side handling of a tick of update_entity messages: the old per message path against
+    # NetworkManager.apply_entity_updates(), both moving real NodePaths
+    import json
+    import random
+    import panda3d.core as p3d
+    import network
+
+    render = p3d.NodePath('render')
+    space = render.attach_new_node('space')
+
+    class PerMessageNodeComponent(ecs.Component):
+        __slots__ = ['nodepath']
+        typeid = 'NODEPATH'
+
+        def __init__(self):
+            super().__init__()
+            self.nodepath = p3d.NodePath('node')
+
+        def update(self, cdata):
+            self.nodepath.set_pos(render, p3d.LVector3(*cdata['position']))
+            self.nodepath.set_hpr(render, p3d.LVector3(*cdata['rotation']))
+            self.nodepath.reparent_to(space)
+
+    class BulkNodeComponent(PerMessageNodeComponent):
+        __slots__ = []
+
+        def update(self, cdata):
+            nodepath = self.nodepath
+            if not nodepath.has_parent():
+                nodepath.reparent_to(space)
+            position = cdata['position']
+            rotation = cdata['rotation']
+            nodepath.set_pos_hpr(position[0], position[1], position[2], rotation[0], rotation[1], rotation[2])
+
+    def make_tick(cls, count, rng):
+        import_string = '{}.{}'.format(cls.__module__, cls.__name__)
+        ecs._component_classes[import_string] = cls
+        return [
+            (netid, json.dumps({'NODEPATH': [{
+                'import_string': import_string,
+                'position': [rng.uniform(-50, 50), rng.uniform(-50, 50), 0.0],
+                'rotation': [rng.uniform(0, 360), 0.0, 0.0],
+            }]}, separators=(',', ':')))
+            for netid in range(1, count + 1)
+        ]
+
+    def apply_per_message(manager, updates):
+        for netid, payload in updates:
+            data = json.loads(payload)
+            entities = [i for i in manager.entities if i.netid == netid]
+            if entities:
+                entity = entities[0]
+            else:
+                entity = manager.create_entity()
+            entity.update(netid, data)
+
+    for count in (100, 500, 2000):
+        for name, cls in (('per message', PerMessageNodeComponent), ('bulk', BulkNodeComponent)):
+            rng = random.Random(0)
+            manager = ecs.ECSManager()
+            network_manager = network.NetworkManager(manager, network.BaseTransportLayer)
+
+            times = []
+            for _ in range(args.ticks):
+                updates = make_tick(cls, count, rng)
+                start = time.perf_counter()
+                if cls is BulkNodeComponent:
+                    network_manager.pending_updates.extend(updates)
+                    network_manager.apply_entity_updates()
+                else:
+                    apply_per_message(manager, updates)
+                times.append(time.perf_counter() - start)
+
+            _report('{}, {} updates'.format(name, count), times)
+
+
+BENCHMARKS = {
+    'systems': bench_systems,
+    'lagcomp': bench_lagcomp,
+    'snapshot-apply': bench_snapshot_apply,
+    'startup': bench_startup,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sigurd micro benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--ticks', type=int, default=100)
+    parser.add_argument('--payload-kb', type=int, default=512)
+    parser.add_argument('--iterations', type=int, default=50000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--history-ticks', type=int, default=60)
+    parser.add_argument('--port', type=int, default=9899)
+    parser.add_argument('--src')
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,109 @@
+import random
+import time
+
+import network
+from actions import Actions
+
+
+class BotNetworkManager(network.NetworkManager):
+    # A client NetworkManager that only consumes snapshots instead of building a scene from them
+    def __init__(self, bot, transport_layer):
+        super().__init__(None, transport_layer, is_server=False)
+        self.bot = bot
+
+    def connection_lost(self, connection):
+        self.bot.player_id = None
+
+    def message_handler(self, connection, msgid, data):
+        if msgid == network.MessageTypes.update_entity:
+            self.bot.snapshots_received += 1
+            self.bot.known_entities.add(data['netid'])
+        elif msgid == network.MessageTypes.remove_entity:
+            self.bot.known_entities.discard(data['netid'])
+        elif msgid == network.MessageTypes.player_id:
+            self.bot.player_id = data['netid']
+        elif msgid == network.MessageTypes.server_time:
+            self.server_time = data['time']
+
+
+class BotClient(object):
+    actions = [
+        Actions.ATTACK,
+        Actions.JUMP,
+        Actions.TRACK_ONE,
+        Actions.TRACK_TWO,
+        Actions.TRACK_THREE,
+        Actions.TRACK_FOUR,
+    ]
+
+    def __init__(self, host, port, transport_layer=network.PandaTransportLayer, seed=None):
+        self.random = random.Random(seed)
+        self.player_id = None
+        self.snapshots_received = 0
+        self.known_entities = set()
+        self.movement_x = 0
+        self.next_decision = 0.0
+        self.last_update = None
+
+        self.network_manager = BotNetworkManager(self, transport_layer)
+        self.input_sender = network.InputSender(self.network_manager)
+        self.network_manager.start_client(host, port)
+        self.network_manager.broadcast(network.MessageTypes.register_player, {})
+
+    def update(self, now):
+        self.network_manager.transport.update()
+        dt = now - self.last_update if self.last_update is not None else 0.0
+        self.last_update = now
+
+        if self.player_id is None:
+            return
+
+        # Wander around, occasionally doing something
+        actions = 0
+        if now >= self.next_decision:
+            self.movement_x = self.random.choice((-1, 0, 1))
+            if self.random.random() < 0.5:
+                actions |= self.random.choice(self.actions)
+            self.next_decision = now + self.random.uniform(0.25, 2.0)
+
+        self.input_sender.update(dt, self.player_id, self.movement_x, actions)
+
+    def shutdown(self):
+        self.network_manager.shutdown()
+
+
+def run_bots(host, port, count, input_rate=30.0, spawn_rate=20.0, report_interval=5.0):
+    bots = []
+    frame_time = 1.0 / input_rate
+    next_spawn = time.perf_counter()
+    next_report = next_spawn + report_interval
+    last_snapshots = 0
+
+    try:
+        while True:
+            now = time.perf_counter()
+
+            # Ramp up instead of opening every connection at once
+            while len(bots) < count and now >= next_spawn:
+                bots.append(BotClient(host, port, seed=len(bots)))
+                next_spawn += 1.0 / spawn_rate
+
+            for bot in bots:
+                bot.update(now)
+
+            if now >= next_report:
+                snapshots = sum(bot.snapshots_received for bot in bots)
+                print('Bots: {} connected, {} registered, {:.0f} snapshots/s'.format(
+                    len(bots),
+                    len([bot for bot in bots if bot.player_id is not None]),
+                    (snapshots - last_snapshots) / report_interval,
+                ))
+                last_snapshots = snapshots
+                next_report += report_interval
+
+            time.sleep(max(frame_time - (time.perf_counter() - now), 0))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for bot in bots:
+            bot.shutdown()
@@ -1,3 +1,9 @@
+import array
+import collections
+import concurrent.futures
+import gc
+import math
+import time
 import weakref
 import importlib
 
@@ -9,31 +15,84 @@ class Component(object):
         'synchronize',
         '_is_unique',
         '_import_string',
+        '_dirty',
+        '__weakref__',
     ]
 
+    # Components that implement reset() can be recycled by a ComponentPool
+    poolable = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _component_classes[cls.__module__ + '.' + cls.__name__] = cls
+
     def __init__(self):
+        self._entity = None
         self._is_unique = False
         self.synchronize = False
         self._import_string = self.__class__.__module__ + '.' + self.__class__.__name__
+        self._dirty = True
 
-    def __del__(self):
-        #print("__del__", self)
+    def cleanup(self):
         pass
 
-    def cleanup(self):
+    def reset(self, *args, **kwargs):
         pass
 
     @property
     def entity(self):
-        return self._entity()
+        return self._entity() if self._entity else None
 
     @property
     def is_unique(self):
         return self._is_unique
 
+    def mark_dirty(self):
+        self._dirty = True
+
+    def is_dirty(self):
+        # Subclasses can extend this with cheap change checks (e.g., comparing transforms)
+        return self._dirty
+
+    def clear_dirty(self):
+        self._dirty = False
+
     def serialize(self):
         return {'import_string': self._import_string}
 
+    def update(self, cdata):
+        pass
+
+    def snapshot(self):
+        # State needed to rebuild the component from a world snapshot, defaults to its network state
+        return self.serialize()
+
+    def restore(self, data):
+        self.update(data)
+
+    @classmethod
+    def snapshot_args(cls, data):
+        # Constructor arguments used to recreate the component from snapshot() data
+        return ()
+
+
+# Every Component subclass registers itself here by import string, so resolving a class is a dict lookup
+_component_classes = {}
+
+
+def resolve_component_class(import_string):
+    try:
+        return _component_classes[import_string]
+    except KeyError:
+        pass
+
+    # Only hit the first time a module that has not been imported yet shows up in a message
+    mod_parts = import_string.split('.')
+    mod = importlib.import_module('.'.join(mod_parts[:-1]))
+    cls = getattr(mod, mod_parts[-1])
+    _component_classes[import_string] = cls
+    return cls
+
 
 class UniqueComponent(Component):
     __slots__ = []
@@ -48,6 +107,8 @@ class Entity(object):
         '_components',
         '_new_components',
         '__weakref__',
+        '_ref',
+        '_manager',
         'guid',
         'space',
         'netid',
@@ -56,21 +117,19 @@ class Entity(object):
     def __init__(self, space):
         self._components = {}
         self._new_components = {}
+        self._ref = weakref.ref(self)
+        self._manager = None
         self.guid = None
         self.space = space
         self.netid = 0
 
-    def __del__(self):
-        for k, v in self._components.items():
-            for i in v:
-                i.cleanup()
+    def reset(self, space):
         self._components.clear()
-
-        for k, v in self._new_components.items():
-            for i in v:
-                i.cleanup()
         self._new_components.clear()
-        #print("__del__", self)
+        self._manager = None
+        self.guid = None
+        self.space = space
+        self.netid = 0
 
     def add_component(self, component):
         typeid = component.typeid
@@ -84,7 +143,7 @@ class Entity(object):
 
         if enforce_unique and self.has_component(typeid):
             raise RuntimeError('Entity already has component with typeid of {}'.format(typeid))
-        component._entity = weakref.ref(self)
+        component._entity = self._ref
 
         if typeid in self._new_components:
             self._new_components[typeid].append(component)
@@ -106,6 +165,9 @@ class Entity(object):
         if not clist:
             del d[component.typeid]
 
+        if d is self._components and self._manager is not None:
+            self._manager.invalidate_queries()
+
     def get_component(self, typeid):
         if len(self.get_components(typeid)) > 1:
             raise RuntimeError('Entity has more than one component with typeid of {}'.format(typeid))
@@ -123,32 +185,50 @@ class Entity(object):
     def has_component(self, typeid):
         return typeid in self._components or typeid in self._new_components
 
-    def serialize(self):
+    def serialize(self, dirty_only=False):
+        # With dirty_only, unchanged components are sent as None to keep list indices stable
         d = {}
         for typeid, clist in self._components.items():
             d[typeid] = []
+            changed = False
             for component in clist:
-                if component.synchronize:
+                if not component.synchronize:
+                    continue
+                if dirty_only:
+                    if component.is_dirty():
+                        d[typeid].append(component.serialize())
+                        component.clear_dirty()
+                        changed = True
+                    else:
+                        d[typeid].append(None)
+                else:
                     d[typeid].append(component.serialize())
-            if not d[typeid]:
+                    changed = True
+            if not changed:
                 del d[typeid]
 
         return d
 
+    def snapshot(self):
+        d = {}
+        for components in (self._components, self._new_components):
+            for typeid, clist in components.items():
+                d.setdefault(typeid, []).extend(component.snapshot() for component in clist)
+        return d
+
     def update(self, netid, d):
         self.netid = netid
         #print(self.netid, d)
         for typeid, clist in d.items():
             for i, cdata in enumerate(clist):
-                mod_parts = cdata['import_string'].split('.')
-                cmod = '.'.join(mod_parts[:-1])
-                cclass = mod_parts[-1]
+                if cdata is None:
+                    continue
 
                 try:
                     component = self.get_components(typeid)[i]
                 except (IndexError, KeyError):
-                    mod = importlib.import_module(cmod)
-                    component = getattr(mod, cclass)()
+                    cls = resolve_component_class(cdata['import_string'])
+                    component = self._manager.acquire_component(cls) if self._manager else cls()
                     self.add_component(component)
 
                 component.update(cdata)
@@ -159,49 +239,398 @@ class System(object):
         'component_types',
     ]
 
+    # Component typeids (or other shared resource names) the system touches. A system that does not
+    # declare its writes is assumed to touch everything and never runs alongside other systems.
+    reads = ()
+    writes = None
+
+    # Names of systems that must be updated before this one
+    run_after = ()
+
+    # Systems that look up their components through ECSManager.query() can set this to False so no
+    # per-type component lists are built for their update() every tick
+    uses_components = True
+
+    # Event types the system emits, {name: ((field, typecode), ...)}, and the methods that handle
+    # drained batches, {name: method_name}. Both are hooked up by ECSManager.add_system().
+    event_types = {}
+    event_handlers = {}
+
     def init_components(self, dt, entities):
         pass
 
     def update(self, dt, entities):
         pass
 
+    def entity_destroyed(self, entity):
+        pass
+
+    def diagnostics(self):
+        return {}
+
 
 class DuplicateSystemException(Exception):
     pass
 
 
-class ECSManager(object):
+class SystemOrderException(Exception):
+    pass
+
+
+def _systems_conflict(first, second):
+    if first.writes is None or second.writes is None:
+        return True
+
+    first_writes = set(first.writes)
+    second_writes = set(second.writes)
+    return bool(
+        first_writes & (second_writes | set(second.reads)) or
+        second_writes & set(first.reads)
+    )
+
+
+class ComponentPool(object):
+    def __init__(self, max_per_type=256):
+        self.max_per_type = max_per_type
+        self._pools = {}
+
+    def acquire(self, cls, *args, **kwargs):
+        pool = self._pools.get(cls)
+        if pool:
+            component = pool.pop()
+            component.reset(*args, **kwargs)
+            component.mark_dirty()
+            return component
+
+        return cls(*args, **kwargs)
+
+    def release(self, component):
+        component._entity = None
+        if not component.poolable:
+            return False
+
+        pool = self._pools.setdefault(component.__class__, [])
+        if len(pool) >= self.max_per_type:
+            return False
+
+        pool.append(component)
+        return True
+
+    def clear(self):
+        self._pools.clear()
+
+    def __len__(self):
+        return sum(len(i) for i in self._pools.values())
+
+
+class Timer(object):
+    __slots__ = [
+        'expires',
+        'interval',
+        'callback',
+        'args',
+        'cancelled',
+    ]
+
+    def __init__(self, expires, interval, callback, args):
+        self.expires = expires
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel(object):
+    # Hierarchical timer wheel: level 0 has one slot per tick, every higher level has slots as wide as
+    # the whole level below it and is only cascaded down when the level below wraps around. Advancing
+    # only touches timers that expire (or cascade), no matter how many are pending.
+    def __init__(self, resolution=1 / 60, slots=(256, 64, 64, 64)):
+        self.resolution = resolution
+        self.tick = 0
+        self.pending = 0
+        self.fired = 0
+        self._accum = 0.0
+        self._advance_to = 0
+        self._wheels = [[[] for _ in range(size)] for size in slots]
+        self._spans = []
+        span = 1
+        for size in slots:
+            self._spans.append(span)
+            span *= size
+        self._range = span
+        self._overflow = []
+
+    def __len__(self):
+        return self.pending
+
+    @property
+    def time(self):
+        return self.tick * self.resolution + self._accum
+
+    def schedule(self, delay, callback, *args):
+        # Calls callback(*args) once delay seconds have passed, rounded up to the next tick
+        return self._add(delay, None, callback, args)
+
+    def every(self, interval, callback, *args):
+        # Calls callback(*args) every interval seconds until cancelled. Periods that pass within a single
+        # advance() are coalesced into one call instead of being replayed back to back.
+        return self._add(interval, interval, callback, args)
+
+    def cancel(self, timer):
+        if not timer.cancelled:
+            timer.cancelled = True
+            self.pending -= 1
+
+    def _ticks(self, delay):
+        return max(int(math.ceil(delay / self.resolution - 1e-9)), 1)
+
+    def _add(self, delay, interval, callback, args):
+        timer = Timer(self.tick + self._ticks(delay), interval, callback, args)
+        self._insert(timer)
+        self.pending += 1
+        return timer
+
+    def _insert(self, timer):
+        delta = timer.expires - self.tick
+        if delta >= self._range:
+            self._overflow.append(timer)
+            return
+        for span, wheel in zip(self._spans, self._wheels):
+            if delta < span * len(wheel):
+                wheel[(timer.expires // span) % len(wheel)].append(timer)
+                return
+
+    def advance(self, dt):
+        self._accum += dt
+        ticks = int(self._accum / self.resolution)
+        self._accum -= ticks * self.resolution
+        self._advance_to = self.tick + ticks
+        for _ in range(ticks):
+            self._tick()
+
+    def _tick(self):
+        self.tick += 1
+        tick = self.tick
+
+        # Cascade from the highest level that wrapped down, so timers can move more than one level
+        top = 0
+        for level in range(1, len(self._wheels)):
+            if tick % self._spans[level]:
+                break
+            top = level
+        if top == len(self._wheels) - 1 and tick % self._range == 0:
+            overflow = self._overflow
+            self._overflow = []
+            for timer in overflow:
+                if not timer.cancelled:
+                    self._insert(timer)
+        for level in range(top, 0, -1):
+            wheel = self._wheels[level]
+            index = (tick // self._spans[level]) % len(wheel)
+            timers = wheel[index]
+            wheel[index] = []
+            for timer in timers:
+                if not timer.cancelled:
+                    self._insert(timer)
+
+        wheel = self._wheels[0]
+        index = tick % len(wheel)
+        timers = wheel[index]
+        wheel[index] = []
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.expires = self._advance_to + self._ticks(timer.interval)
+                self._insert(timer)
+            else:
+                timer.cancelled = True
+                self.pending -= 1
+            self.fired += 1
+            timer.callback(*timer.args)
+
+
+# Typecode for event fields that hold an entity guid
+GUID = 'guid'
+
+
+class DuplicateEventTypeException(Exception):
+    pass
+
+
+class EventBatch(object):
+    # Events of one type stored column-wise, one typed array per field. Iterating yields a tuple per event.
+    __slots__ = [
+        'name',
+        'fields',
+        'columns',
+    ]
+
+    def __init__(self, name, fields, typecodes):
+        self.name = name
+        self.fields = fields
+        self.columns = [array.array(typecode) for typecode in typecodes]
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        return zip(*self.columns)
+
+    def column(self, field):
+        return self.columns[self.fields.index(field)]
+
+    def discard(self, field_index, value):
+        column = self.columns[field_index]
+        if value not in column:
+            return
+        keep = [i for i, v in enumerate(column) if v != value]
+        self.columns = [array.array(c.typecode, [c[i] for i in keep]) for c in self.columns]
+
+
+class EventBus(object):
+    # Events are appended to a pending batch per type and only handed to subscribers, a whole batch at
+    # a time, by drain(). Types drain in registration order, so an event emitted by a subscriber is
+    # still delivered this drain if its type was registered later. Pending events that refer to an
+    # entity (GUID fields) are dropped when that entity is removed.
     def __init__(self):
+        self._types = {}
+        self._pending = {}
+        self._subscribers = collections.defaultdict(list)
+        self.emitted = collections.Counter()
+
+    def register(self, name, fields):
+        if name in self._types:
+            raise DuplicateEventTypeException('{} has already been registered.'.format(name))
+        names = tuple([field for field, _ in fields])
+        typecodes = tuple(['q' if typecode == GUID else typecode for _, typecode in fields])
+        guid_fields = tuple([i for i, (_, typecode) in enumerate(fields) if typecode == GUID])
+        self._types[name] = (names, typecodes, guid_fields)
+        self._pending[name] = EventBatch(name, names, typecodes)
+
+    def subscribe(self, name, callback):
+        self._subscribers[name].append(callback)
+
+    def unsubscribe(self, name, callback):
+        self._subscribers[name].remove(callback)
+
+    def emit(self, name, *values):
+        batch = self._pending[name]
+        if len(values) != len(batch.fields):
+            raise TypeError('{} events have the fields {}'.format(name, ', '.join(batch.fields)))
+        for column, value in zip(batch.columns, values):
+            column.append(value)
+
+    def pending(self, name):
+        return len(self._pending[name])
+
+    def discard_entity(self, guid):
+        for name, (_, _, guid_fields) in self._types.items():
+            batch = self._pending[name]
+            for index in guid_fields:
+                batch.discard(index, guid)
+
+    def drain(self):
+        for name, (fields, typecodes, _) in self._types.items():
+            batch = self._pending[name]
+            if not len(batch):
+                continue
+            self._pending[name] = EventBatch(name, fields, typecodes)
+            self.emitted[name] += len(batch)
+            for callback in self._subscribers[name]:
+                callback(batch)
+
+
+class ECSManager(object):
+    def __init__(self, max_pooled_entities=1024, max_workers=0, timer_resolution=1 / 60):
         self.entities = []
         self.systems = {}
+        self._schedule = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers) if max_workers > 0 else None
+        self.system_times = {}
         self.next_entity_guid = 0
         self.space = Entity(None)
         self.removed_entities = set()
+        self.max_pooled_entities = max_pooled_entities
+        self.entity_pool = []
+        self.component_pool = ComponentPool()
+        self.destroy_queue = collections.deque()
+        self._queries = {}
+        self.timers = TimerWheel(timer_resolution)
+        self.events = EventBus()
+        self._entities_by_guid = {}
 
     def create_entity(self):
         # TODO allow for multiple spaces
         if self.space is None:
             raise RuntimeError("ECSManager.space is None")
-        entity = Entity(self.space)
+        if self.entity_pool:
+            entity = self.entity_pool.pop()
+            entity.reset(self.space)
+        else:
+            entity = Entity(self.space)
         self._add_entity(entity)
 
         return entity
 
+    def acquire_component(self, cls, *args, **kwargs):
+        return self.component_pool.acquire(cls, *args, **kwargs)
+
     def _add_entity(self, entity):
         entity.guid = self.next_entity_guid
+        entity._manager = self
         self.next_entity_guid += 1
         self.entities.append(entity)
+        self._entities_by_guid[entity.guid] = entity
+
+    def get_entity(self, guid):
+        # The live entity with the given guid, or None once it has been removed
+        return self._entities_by_guid.get(guid)
 
     def remove_entity(self, entity):
+        # Entities leave the simulation immediately, but are only destroyed by flush_destroy_queue()
+        if entity not in self.entities:
+            return
         if entity.netid != 0:
             self.removed_entities.add(entity.netid)
         self.entities.remove(entity)
+        del self._entities_by_guid[entity.guid]
+        self.events.discard_entity(entity.guid)
+        self.destroy_queue.append(entity)
+        self.invalidate_queries()
+
+    def flush_destroy_queue(self):
+        # Cleanup may queue more entities (e.g., character tracks), so keep going until empty
+        while self.destroy_queue:
+            entity = self.destroy_queue.popleft()
+            for system in self.systems.values():
+                system.entity_destroyed(entity)
+            self.release_entity(entity)
+
+    def release_entity(self, entity):
+        # Explicitly clean up and recycle the entity and its components
+        for components in (entity._components, entity._new_components):
+            for clist in list(components.values()):
+                for component in clist:
+                    component.cleanup()
+                    self.component_pool.release(component)
+            components.clear()
+
+        entity.reset(None)
+        if len(self.entity_pool) < self.max_pooled_entities:
+            self.entity_pool.append(entity)
 
     def add_system(self, system):
         name = system.__class__.__name__
         if name in self.systems:
             raise DuplicateSystemException("{} has already been added.".format(name))
         self.systems[name] = system
+        self._schedule = None
+
+        for event_name, fields in system.event_types.items():
+            self.events.register(event_name, fields)
+        for event_name, method in system.event_handlers.items():
+            self.events.subscribe(event_name, getattr(system, method))
 
     def has_system(self, system_str):
         return system_str in self.systems
@@ -214,16 +643,156 @@ class ECSManager(object):
     def remove_system(self, system_str):
         if system_str not in self.systems:
             raise KeyError('No system found with the name of {}'.format(system_str))
+        system = self.systems[system_str]
+        for event_name, method in system.event_handlers.items():
+            self.events.unsubscribe(event_name, getattr(system, method))
         del self.systems[system_str]
+        self._schedule = None
+
+    def build_schedule(self):
+        # Systems that conflict keep their insertion order, run_after adds explicit edges,
+        # and every system lands in the earliest stage after all of its dependencies
+        names = list(self.systems.keys())
+        dependencies = {name: set() for name in names}
+        for i, name in enumerate(names):
+            system = self.systems[name]
+            for earlier in names[:i]:
+                if _systems_conflict(self.systems[earlier], system):
+                    dependencies[name].add(earlier)
+        for name in names:
+            for after in self.systems[name].run_after:
+                if after not in self.systems:
+                    raise SystemOrderException('{} must run after unknown system {}'.format(name, after))
+                dependencies[name].add(after)
+                dependencies[after].discard(name)
+
+        stages = []
+        stage_of = {}
+        remaining = names[:]
+        while remaining:
+            ready = [name for name in remaining if dependencies[name].issubset(stage_of)]
+            if not ready:
+                raise SystemOrderException('Cyclic system ordering between: {}'.format(', '.join(remaining)))
+            for name in ready:
+                stage = max([stage_of[dep] + 1 for dep in dependencies[name]], default=0)
+                stage_of[name] = stage
+                if stage == len(stages):
+                    stages.append([])
+                stages[stage].append(name)
+                remaining.remove(name)
+
+        return stages
+
+    @property
+    def schedule(self):
+        if self._schedule is None:
+            self._schedule = self.build_schedule()
+        return self._schedule
+
+    def _update_system(self, name, dt, components):
+        start = time.perf_counter()
+        self.systems[name].update(dt, components)
+        self.system_times[name] = time.perf_counter() - start
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
 
     def remove_space(self):
         # TODO allow for multiple spaces
         for entity in self.entities[:]:
             if entity.space == self.space:
-                self.entities.remove(entity)
+                self.remove_entity(entity)
 
+        self.flush_destroy_queue()
+
+        if self.space is not None:
+            self.release_entity(self.space)
         self.space = None
 
+    def leak_report(self):
+        live_entities = 0
+        live_components = collections.Counter()
+        for obj in gc.get_objects():
+            if isinstance(obj, Entity):
+                live_entities += 1
+            elif isinstance(obj, Component):
+                live_components[obj.typeid] += 1
+
+        active_components = collections.Counter()
+        for entity in self.entities:
+            for components in (entity._components, entity._new_components):
+                for typeid, clist in components.items():
+                    active_components[typeid] += len(clist)
+
+        pooled_components = collections.Counter()
+        for cls, pool in self.component_pool._pools.items():
+            pooled_components[cls.typeid] += len(pool)
+
+        # Anything alive that is neither in the simulation nor in a pool is being kept around by a stray reference
+        return {
+            'entities': {
+                'active': len(self.entities),
+                'pending_destroy': len(self.destroy_queue),
+                'pooled': len(self.entity_pool),
+                'live': live_entities,
+            },
+            'components': {
+                typeid: {
+                    'active': active_components[typeid],
+                    'pooled': pooled_components[typeid],
+                    'live': live_components[typeid],
+                }
+                for typeid in sorted(set(live_components) | set(active_components))
+            },
+            'timers': len(self.timers),
+            'events': dict(self.events.emitted),
+            'systems': {name: system.diagnostics() for name, system in self.systems.items()},
+        }
+
+    def print_leak_report(self):
+        report = self.leak_report()
+        print('Entities: {active} active, {pending_destroy} pending destroy, {pooled} pooled, {live} live'.format(
+            **report['entities']
+        ))
+        for typeid, counts in report['components'].items():
+            print('  {}: {active} active, {pooled} pooled, {live} live'.format(typeid, **counts))
+        print('Timers: {} pending'.format(report['timers']))
+        print('Events: {}'.format(', '.join(
+            '{} {}'.format(count, name) for name, count in sorted(report['events'].items())
+        ) or 'none'))
+        for name, diagnostics in report['systems'].items():
+            for key, value in sorted(diagnostics.items()):
+                print('  {}.{}: {}'.format(name, key, value))
+
+    def query(self, required, optional=()):
+        # Returns a list of component tuples, one per entity that has every required type, followed by
+        # the optional types (None when missing). Only the first component of each type is used and
+        # components added this tick show up once they are initialized. Results are cached until
+        # an entity or component is added or removed.
+        key = (required, optional)
+        rows = self._queries.get(key)
+        if rows is None:
+            rows = []
+            for entity in self.entities:
+                components = entity._components
+                try:
+                    row = tuple([components[typeid][0] for typeid in required])
+                except KeyError:
+                    continue
+                rows.append(row + tuple([
+                    components[typeid][0] if typeid in components else None
+                    for typeid in optional
+                ]))
+            self._queries[key] = rows
+        return rows
+
+    def invalidate_queries(self):
+        # Swap instead of clearing so systems iterating a cached result are not affected
+        if self._queries:
+            self._queries = {}
+
     def _get_components_by_type(self, component_list, component_types):
         components = {k: [] for k in component_types}
         for entity in self.entities:
@@ -232,6 +801,11 @@ class ECSManager(object):
 
         return components
 
+    def _get_system_components(self, system):
+        if not system.uses_components:
+            return {}
+        return self._get_components_by_type('_components', system.component_types)
+
     def update(self, dt):
         entities = self.entities[:]
 
@@ -239,13 +813,36 @@ class ECSManager(object):
             system.init_components(dt, self._get_components_by_type('_new_components', system.component_types))
 
         for entity in entities:
+            if not entity._new_components:
+                continue
             for typeid, clist in entity._new_components.items():
                 if typeid in entity._components:
                     entity._components[typeid].extend(clist)
                 else:
                     entity._components[typeid] = clist[:]
             entity._new_components.clear()
-
-        for system in self.systems.values():
-            system.update(dt, self._get_components_by_type('_components', system.component_types))
+            self.invalidate_queries()
+
+        self.system_times = {}
+        for stage in self.schedule:
+            if self._executor is None or len(stage) == 1:
+                for name in stage:
+                    components = self._get_system_components(self.systems[name])
+                    self._update_system(name, dt, components)
+            else:
+                futures = []
+                for name in stage:
+                    components = self._get_system_components(self.systems[name])
+                    futures.append(self._executor.submit(self._update_system, name, dt, components))
+                for future in futures:
+                    future.result()
+
+        # Events are handled on this thread once every system is done, entities removed by the handlers
+        # are destroyed right after
+        self.events.drain()
+
+        self.flush_destroy_queue()
+
+        # Timers fire after the systems ran, callbacks see this tick's state
+        self.timers.advance(dt)
 
@@ -3,38 +3,99 @@ import ecs
 class EffectComponent(ecs.Component):
     __slots__ = [
         'cmd_queue',
-        'effect_type'
+        'effect_type',
+        'cooldown',
+        'duration',
+        'cooldown_timer',
+        'duration_timer',
     ]
     typeid = 'EFFECT'
 
     def __init__(self):
         super().__init__()
         self.cmd_queue = set()
+        self.cooldown = 0.0
+        self.duration = 0.0
+        self.cooldown_timer = None
+        self.duration_timer = None
+
+    def reset(self, effect_data):
+        self.cmd_queue.clear()
+        self.cooldown = effect_data.get('cooldown', 0.0)
+        self.duration = effect_data.get('duration', 0.0)
+
+    def cleanup(self):
+        timers = base.ecsmanager.timers
+        for timer in (self.cooldown_timer, self.duration_timer):
+            if timer is not None:
+                timers.cancel(timer)
+        self.cooldown_timer = None
+        self.duration_timer = None
 
 class PrintEffectComponent(EffectComponent):
     __slots__ = ['message']
     effect_type = 'PRINT'
+    poolable = True
 
     def __init__(self, effect_data):
         super().__init__()
-        EffectComponent.__init__(self)
+        self.reset(effect_data)
+
+    def reset(self, effect_data):
+        super().reset(effect_data)
         self.message = effect_data['message']
 
 class EffectSystem(ecs.System):
-    __slots__ = []
+    __slots__ = [
+        'blocked_activations',
+    ]
 
     component_types = [
         'EFFECT',
     ]
 
+    reads = ('EFFECT',)
+    writes = ('EFFECT',)
+
+    def __init__(self):
+        super().__init__()
+        self.blocked_activations = 0
+
     def update(self, dt, components):
         for component in components['EFFECT']:
-            cfunc = component.effect_type.lower() + '_effect'
             if 'ACTIVATE' in component.cmd_queue:
-                getattr(self, cfunc)(dt, component)
                 component.cmd_queue.remove('ACTIVATE')
+                if component.cooldown_timer is not None:
+                    self.blocked_activations += 1
+                    continue
+                self.activate(dt, component)
 
-    def print_effect(self, dt, component):
-        print(component.message)
+    def activate(self, dt, component):
+        # Durations and cooldowns run on the ECS timer wheel, an effect can provide
+        # <type>_effect_end to be told when its duration is up
+        timers = base.ecsmanager.timers
+        effect_name = component.effect_type.lower()
+        getattr(self, effect_name + '_effect')(dt, component)
+
+        end_func = getattr(self, effect_name + '_effect_end', None)
+        if component.duration > 0 and end_func is not None:
+            if component.duration_timer is not None:
+                timers.cancel(component.duration_timer)
+            component.duration_timer = timers.schedule(component.duration, self._end_effect, end_func, component)
+        if component.cooldown > 0:
+            component.cooldown_timer = timers.schedule(component.cooldown, self._end_cooldown, component)
 
+    def _end_effect(self, end_func, component):
+        component.duration_timer = None
+        end_func(component)
 
+    def _end_cooldown(self, component):
+        component.cooldown_timer = None
+
+    def diagnostics(self):
+        return {
+            'blocked_activations': self.blocked_activations,
+        }
+
+    def print_effect(self, dt, component):
+        print(component.message)
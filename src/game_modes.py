@@ -1,9 +1,13 @@
 import random
 
 from direct.showbase.DirectObject import DirectObject
+import panda3d.core as p3d
 
+import ecs
 import network
-from player import *
+import snapshot
+import streaming
+from player import Actions, ActorComponent, CharacterComponent, NodePathComponent, PlayerComponent
 from physics import HitBoxComponent, StaticPhysicsMeshComponent, CharacterPhysicsComponent
 
 
@@ -17,12 +21,15 @@ class GameMode(object):
     def is_game_over(self):
         pass
 
+    def handle_disconnect(self, connection, netid):
+        pass
+
 
 class LevelData(object):
     def __init__(self, level, parent):
         # Load model and setup entity
         self.entity = base.ecsmanager.create_entity()
-        np_component = NodePathComponent('models/level2d')
+        np_component = NodePathComponent(level)
         nodepath = np_component.nodepath
         nodepath.reparent_to(parent)
         self.entity.add_component(np_component)
@@ -50,10 +57,19 @@ class ClassicGameMode(GameMode, DirectObject):
     def __init__(self):
         self.player_id = None
         self.player = None
-        self.action_set = set()
+        self.actions = 0
         self.movement = p3d.LVector3f(0, 0, 0)
 
         self.level_data = None
+        # Capturing a baseline walks every networked entity, only pay for it when it can be used
+        self.fast_restart_enabled = p3d.ConfigVariableBool('fast-restart', False).get_value()
+        self.baseline = None
+        self._baseline_frame = None
+
+        # Set by the overload governor, registrations wait in pending_spawns until it is cleared
+        self.spawns_paused = False
+        self.pending_spawns = []
+        self.input_sender = network.InputSender(base.network_manager)
 
         def update_movement(direction, activate):
             move_delta = p3d.LVector3(0, 0, 0)
@@ -79,14 +95,17 @@ class ClassicGameMode(GameMode, DirectObject):
         self.accept('move-left-up', update_movement, ['left', False])
         self.accept('move-right', update_movement, ['right', True])
         self.accept('move-right-up', update_movement, ['right', False])
-        self.accept('jump', self.action_set.add, ['JUMP'])
-        self.accept('attack', self.action_set.add, ['ATTACK'])
-        self.accept('track-one', self.action_set.add, ['TRACK_ONE'])
-        self.accept('track-two', self.action_set.add, ['TRACK_TWO'])
-        self.accept('track-three', self.action_set.add, ['TRACK_THREE'])
-        self.accept('track-four', self.action_set.add, ['TRACK_FOUR'])
-        self.accept('abort', self.action_set.add, ['ABORT_START'])
-        self.accept('abort-up', self.action_set.add, ['ABORT_END'])
+        self.accept('jump', self.add_action, [Actions.JUMP])
+        self.accept('attack', self.add_action, [Actions.ATTACK])
+        self.accept('track-one', self.add_action, [Actions.TRACK_ONE])
+        self.accept('track-two', self.add_action, [Actions.TRACK_TWO])
+        self.accept('track-three', self.add_action, [Actions.TRACK_THREE])
+        self.accept('track-four', self.add_action, [Actions.TRACK_FOUR])
+        self.accept('abort', self.add_action, [Actions.ABORT_START])
+        self.accept('abort-up', self.add_action, [Actions.ABORT_END])
+
+    def add_action(self, action):
+        self.actions |= action
 
     def update_movement(self, direction, activate):
         move_delta = p3d.LVector3(0, 0, 0)
@@ -111,7 +130,11 @@ class ClassicGameMode(GameMode, DirectObject):
         spacenp = base.ecsmanager.space.get_component('NODEPATH').nodepath
         spacenp.reparent_to(base.render)
 
-        self.level_data = LevelData('models/level2d', spacenp)
+        level = 'models/level2d'
+        if streaming.has_chunks(level):
+            self.level_data = streaming.ChunkedLevelData(level, spacenp)
+        else:
+            self.level_data = LevelData(level, spacenp)
         if base.camera:
             base.camera.set_hpr(0, 0, 0)
             base.camera.set_y(-30)
@@ -119,6 +142,9 @@ class ClassicGameMode(GameMode, DirectObject):
             ortho_lens.set_film_size(35)
             base.cam.node().set_lens(ortho_lens)
 
+        if base.network_manager.netrole == 'SERVER':
+            self.request_baseline()
+
         if base.network_manager.netrole == 'CLIENT':
             base.network_manager.broadcast(network.MessageTypes.register_player, {})
 
@@ -141,13 +167,20 @@ class ClassicGameMode(GameMode, DirectObject):
         #        enemy.add_component(AiComponent())
 
     def update(self, dt):
+        # The ECS task runs before this one, so components added in an earlier frame are initialized
+        if self._baseline_frame is not None and globalClock.get_frame_count() > self._baseline_frame:
+            self.capture_baseline()
+
+        if self.pending_spawns and not self.spawns_paused:
+            connections = base.network_manager.transport.connections
+            for connection in self.pending_spawns:
+                if connection in connections:
+                    self.spawn_player(connection)
+            self.pending_spawns.clear()
+
         if self.player:
-            base.network_manager.broadcast(network.MessageTypes.player_input, {
-                'netid': self.player.netid,
-                'movement_x': int(self.movement.get_x()),
-                'action_set': ','.join(self.action_set),
-            })
-            self.action_set.clear()
+            if self.input_sender.update(dt, self.player.netid, self.movement.get_x(), self.actions):
+                self.actions = 0
 
         elif self.player_id is not None:
             player_entity = [entity for entity in base.ecsmanager.entities if entity.netid == self.player_id]
@@ -160,37 +193,117 @@ class ClassicGameMode(GameMode, DirectObject):
     def handle_net_message(self, connection, msgid, data):
         if base.network_manager.netrole == 'SERVER':
             if msgid == network.MessageTypes.register_player:
-                print("Create player")
-                spacenp = base.ecsmanager.space.get_component('NODEPATH').nodepath
-                player = base.ecsmanager.create_entity()
-                base.network_manager.register_entity(player)
-                np_component = NodePathComponent()
-                np_component.nodepath.reparent_to(spacenp)
-                player.add_component(np_component)
-                player.add_component(CharacterComponent('melee'))
-                player.add_component(ActorComponent('melee'))
-                player.add_component(PlayerComponent())
-                player.add_component(HitBoxComponent())
-                player.add_component(CharacterPhysicsComponent())
-
-                np_component.nodepath.set_pos(random.choice(self.level_data.start_positions))
-                np_component.nodepath.set_h(-90)
-
-                base.network_manager.send_to(connection, network.MessageTypes.player_id, {
-                    'netid': player.netid,
-                })
+                if self.spawns_paused:
+                    self.pending_spawns.append(connection)
+                else:
+                    self.spawn_player(connection)
             elif msgid == network.MessageTypes.player_input:
                 player_entity = [entity for entity in base.ecsmanager.entities if entity.netid == data['netid']]
                 if player_entity:
-                    pc = player_entity[0].get_component('CHARACTER')
-                    pc.movement = p3d.LVector3(data['movement_x'], 0, 0)
-                    pc.action_set |= set(data['action_set'].split(','))
+                    self.apply_input(player_entity[0], data)
         else:
             if msgid == network.MessageTypes.player_id:
                 print("Player ID is", data['netid'])
                 self.player_id = data['netid']
 
+    def handle_disconnect(self, connection, netid):
+        if connection in self.pending_spawns:
+            self.pending_spawns.remove(connection)
+
+        player_entity = [entity for entity in base.ecsmanager.entities if netid and entity.netid == netid]
+        if player_entity:
+            print("Remove player", netid)
+            base.ecsmanager.remove_entity(player_entity[0])
+
+            # Fast restarts should not bring the player back
+            self.request_baseline()
+
+    def request_baseline(self):
+        if not self.fast_restart_enabled:
+            return
+
+        # Components added this frame are only initialized by the next ECS update, capture after it
+        self._baseline_frame = globalClock.get_frame_count()
+
+    def spawn_player(self, connection):
+        print("Create player")
+        spacenp = base.ecsmanager.space.get_component('NODEPATH').nodepath
+        player = base.ecsmanager.create_entity()
+        base.network_manager.register_entity(player)
+        acquire = base.ecsmanager.acquire_component
+        np_component = acquire(NodePathComponent)
+        np_component.nodepath.reparent_to(spacenp)
+        player.add_component(np_component)
+        player.add_component(acquire(CharacterComponent, 'melee'))
+        player.add_component(acquire(ActorComponent, 'melee'))
+        player.add_component(acquire(PlayerComponent))
+        player.add_component(acquire(HitBoxComponent))
+        player.add_component(acquire(CharacterPhysicsComponent))
+
+        spawn_pos = random.choice(self.level_data.start_positions)
+        if base.ecsmanager.has_system('LevelStreamingSystem'):
+            base.ecsmanager.get_system('LevelStreamingSystem').load_around([spawn_pos])
+        np_component.nodepath.set_pos(spawn_pos)
+        np_component.nodepath.set_h(-90)
+
+        base.network_manager.set_connection_entity(connection, player)
+        self.request_baseline()
+        base.network_manager.send_to(connection, network.MessageTypes.player_id, {
+            'netid': player.netid,
+        })
+
+    def apply_input(self, entity, data):
+        stats = base.network_manager.input_stats
+        stats['messages'] += 1
+        pc = entity.get_component('CHARACTER')
+        player = entity.get_component('PLAYER')
+
+        # Skip inputs already applied from earlier messages
+        first_sequence = data['sequence'] - len(data['inputs']) + 1
+        new_inputs = [
+            i for sequence, i in enumerate(data['inputs'], first_sequence)
+            if sequence > player.last_input_sequence
+        ]
+        if not new_inputs:
+            stats['duplicate'] += 1
+            return
+
+        # Anything between the last applied input and the oldest one in this message was lost
+        stats['dropped'] += max(data['sequence'] - len(new_inputs) - player.last_input_sequence, 0)
+        stats['recovered'] += len(new_inputs) - 1
+
+        for movement_x, actions in new_inputs:
+            pc.actions |= actions
+        pc.movement = p3d.LVector3(new_inputs[-1][0], 0, 0)
+        player.last_input_sequence = data['sequence']
+        player.view_time = data['view_time']
+
+    def capture_baseline(self):
+        # World state a fast restart returns to, including every registered player at their spawn
+        self._baseline_frame = None
+        self.baseline = snapshot.capture(base.ecsmanager, base.network_manager.next_netid)
+
+    def load_snapshot(self, data, owned_players_only=False):
+        # Players from another server run have no connection to reclaim them, they would never be removed
+        skip = None
+        if owned_players_only:
+            owned = {i.entity_netid for i in base.network_manager.connection_states.values()}
+            skip = lambda netid, components: 'PLAYER' in components and netid not in owned
+
+        next_netid = snapshot.restore(base.ecsmanager, data, skip)
+        base.network_manager.next_netid = max(base.network_manager.next_netid, next_netid)
+
+    def fast_restart(self):
+        # Reset to the baseline without reloading the level or re-registering players
+        if base.network_manager.netrole != 'SERVER' or self.baseline is None or self.level_data is None:
+            return False
+
+        self.load_snapshot(self.baseline)
+        return True
+
     def end_game(self):
+        self._baseline_frame = None
+        self.baseline = None
         base.ecsmanager.remove_space()
         #base.render.ls()
 
@@ -0,0 +1,76 @@
+import panda3d.core as p3d
+
+
+class OverloadGovernor(object):
+    # Watches server tick durations and, when too many ticks overrun the frame budget, sheds load one
+    # step at a time: AI thinks less often, far and idle entities get fewer snapshots, then new players
+    # wait to spawn. Steps are undone in reverse order once ticks have headroom again.
+    steps = ('ai', 'snapshots', 'spawns')
+
+    def __init__(self, ecsmanager, network_manager, game_mode, target_rate):
+        self.ecsmanager = ecsmanager
+        self.network_manager = network_manager
+        self.game_mode = game_mode
+        self.budget = 1.0 / target_rate
+        self.window = p3d.ConfigVariableInt('governor-window-ticks', 60).get_value()
+        self.overrun_fraction = p3d.ConfigVariableDouble('governor-overrun-fraction', 0.25).get_value()
+        self.headroom_ratio = p3d.ConfigVariableDouble('governor-headroom-ratio', 0.6).get_value()
+        self.ai_think_scale = p3d.ConfigVariableDouble('governor-ai-think-scale', 2.0).get_value()
+        self.snapshot_divisor = p3d.ConfigVariableInt('governor-snapshot-divisor', 3).get_value()
+
+        self.level = 0
+        self.changes = 0
+        self._ticks = 0
+        self._overruns = 0
+        self._total = 0.0
+
+    def record(self, duration):
+        self._ticks += 1
+        self._total += duration
+        if duration > self.budget:
+            self._overruns += 1
+        if self._ticks < self.window:
+            return
+
+        mean = self._total / self._ticks
+        if self._overruns >= self._ticks * self.overrun_fraction and self.level < len(self.steps):
+            self.set_level(self.level + 1, mean)
+        elif not self._overruns and mean <= self.budget * self.headroom_ratio and self.level > 0:
+            self.set_level(self.level - 1, mean)
+
+        self._ticks = 0
+        self._overruns = 0
+        self._total = 0.0
+
+    def set_level(self, level, mean=0.0):
+        if level > self.level:
+            step = self.steps[level - 1]
+            action = 'Degrading'
+        else:
+            step = self.steps[level]
+            action = 'Restoring'
+        print('Governor: {} {} (level {}/{}), mean tick {:.2f}ms for a {:.2f}ms budget, {} of {} ticks over'.format(
+            action,
+            step,
+            level,
+            len(self.steps),
+            mean * 1000,
+            self.budget * 1000,
+            self._overruns,
+            self._ticks,
+        ))
+
+        self.level = level
+        self.changes += 1
+        degraded = self.steps[:level]
+
+        if self.ecsmanager.has_system('AiSystem'):
+            self.ecsmanager.get_system('AiSystem').think_scale = self.ai_think_scale if 'ai' in degraded else 1.0
+        self.network_manager.shed_intervals = self.snapshot_divisor if 'snapshots' in degraded else 0
+        self.game_mode.spawns_paused = 'spawns' in degraded
+
+    def diagnostics(self):
+        return {
+            'level': self.level,
+            'changes': self.changes,
+        }
@@ -0,0 +1,170 @@
+from __future__ import division
+
+import collections
+import math
+
+import panda3d.core as p3d
+
+import ecs
+from physics import HitBoxComponent
+
+
+def ray_box(origin, direction, center, heading, half_extents):
+    # Slab test of the segment origin + direction * t (0 <= t <= 1) against a box rotated about Z,
+    # returns the entry t or None
+    rad = math.radians(heading)
+    cos_h = math.cos(rad)
+    sin_h = math.sin(rad)
+
+    # Move the segment into the box's frame
+    rx = origin[0] - center[0]
+    ry = origin[1] - center[1]
+    local_origin = (rx * cos_h + ry * sin_h, -rx * sin_h + ry * cos_h, origin[2] - center[2])
+    local_direction = (
+        direction[0] * cos_h + direction[1] * sin_h,
+        -direction[0] * sin_h + direction[1] * cos_h,
+        direction[2],
+    )
+
+    t_min = 0.0
+    t_max = 1.0
+    for o, d, extent in zip(local_origin, local_direction, half_extents):
+        if abs(d) < 1e-9:
+            if o < -extent or o > extent:
+                return None
+            continue
+        t0 = (-extent - o) / d
+        t1 = (extent - o) / d
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_min = max(t_min, t0)
+        t_max = min(t_max, t1)
+        if t_min > t_max:
+            return None
+
+    return t_min
+
+
+def _lerp_heading(h0, h1, t):
+    delta = (h1 - h0 + 180.0) % 360.0 - 180.0
+    return h0 + delta * t
+
+
+class HitboxHistory(object):
+    # Ring buffer of (time, {guid: (x, y, z, heading)}) records, one per server tick
+    def __init__(self, max_ticks, half_extents, offset=(0.0, 0.0, 0.0)):
+        self.records = collections.deque(maxlen=max_ticks)
+        self.half_extents = half_extents
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.records)
+
+    def clear(self):
+        self.records.clear()
+
+    def record(self, time, transforms):
+        self.records.append((time, transforms))
+
+    def rewind(self, time, bounds=None):
+        # Hitbox transforms interpolated to the given time, clamped to the recorded range. If bounds
+        # (min_x, min_y, max_x, max_y) are given, hitboxes that cannot be inside them are skipped.
+        if not self.records:
+            return {}
+
+        newer = None
+        for record in reversed(self.records):
+            if record[0] <= time:
+                break
+            newer = record
+        older = record
+        if newer is None:
+            newer = older
+
+        t = (time - older[0]) / (newer[0] - older[0]) if newer[0] != older[0] else 0.0
+        newer_transforms = newer[1]
+        transforms = {}
+        for guid, (x0, y0, z0, h0) in older[1].items():
+            if guid not in newer_transforms:
+                continue
+            x1, y1, z1, h1 = newer_transforms[guid]
+            if bounds is not None and (
+                    (x0 < bounds[0] and x1 < bounds[0]) or (x0 > bounds[2] and x1 > bounds[2]) or
+                    (y0 < bounds[1] and y1 < bounds[1]) or (y0 > bounds[3] and y1 > bounds[3])):
+                continue
+            transforms[guid] = (
+                x0 + (x1 - x0) * t,
+                y0 + (y1 - y0) * t,
+                z0 + (z1 - z0) * t,
+                _lerp_heading(h0, h1, t),
+            )
+        return transforms
+
+    def ray_cast(self, from_pos, to_pos, time, exclude=None):
+        # Closest (t, guid) hit of the segment against hitboxes as they were at the given time
+        direction = (to_pos[0] - from_pos[0], to_pos[1] - from_pos[1], to_pos[2] - from_pos[2])
+        offset = self.offset
+
+        # Only interpolate hitboxes whose bounding circle could touch the segment
+        radius = math.hypot(abs(offset[0]) + self.half_extents[0], abs(offset[1]) + self.half_extents[1])
+        bounds = (
+            min(from_pos[0], to_pos[0]) - radius,
+            min(from_pos[1], to_pos[1]) - radius,
+            max(from_pos[0], to_pos[0]) + radius,
+            max(from_pos[1], to_pos[1]) + radius,
+        )
+
+        closest = None
+        for guid, (x, y, z, heading) in self.rewind(time, bounds).items():
+            if guid == exclude:
+                continue
+            center = (x + offset[0], y + offset[1], z + offset[2])
+            t = ray_box(from_pos, direction, center, heading, self.half_extents)
+            if t is not None and (closest is None or t < closest[0]):
+                closest = (t, guid)
+        return closest
+
+
+class LagCompensationSystem(ecs.System):
+    # Records where every hitbox was each server tick so attacks can be checked against what the
+    # attacker was seeing when they pressed the button
+    component_types = [
+        'PHY_HITBOX',
+    ]
+
+    reads = ('PHY_HITBOX', 'NODEPATH')
+    writes = ('HITBOX_HISTORY',)
+
+    def __init__(self):
+        super().__init__()
+        self.history = HitboxHistory(
+            p3d.ConfigVariableInt('lagcomp-history-ticks', 60).get_value(),
+            HitBoxComponent.half_extents,
+            HitBoxComponent.offset,
+        )
+        self.max_rewind = p3d.ConfigVariableDouble('lagcomp-max-rewind-ms', 500.0).get_value() / 1000.0
+        self.rewinds = 0
+        self.clamped_rewinds = 0
+
+    def update(self, dt, components):
+        transforms = {}
+        for hit_box in components['PHY_HITBOX']:
+            net_transform = p3d.NodePath(hit_box.physics_node).get_net_transform()
+            pos = net_transform.get_pos()
+            transforms[hit_box.entity.guid] = (pos[0], pos[1], pos[2], net_transform.get_hpr()[0])
+        self.history.record(globalClock.get_frame_time(), transforms)
+
+    def ray_cast(self, from_pos, to_pos, view_time, exclude=None):
+        now = globalClock.get_frame_time()
+        self.rewinds += 1
+        if now - view_time > self.max_rewind:
+            view_time = now - self.max_rewind
+            self.clamped_rewinds += 1
+        return self.history.ray_cast(from_pos, to_pos, view_time, exclude)
+
+    def diagnostics(self):
+        return {
+            'history_ticks': len(self.history),
+            'rewinds': self.rewinds,
+            'clamped_rewinds': self.clamped_rewinds,
+        }
@@ -6,59 +6,65 @@ import subprocess
 import time
 import atexit
 
-from direct.showbase.ShowBase import ShowBase
 import panda3d.core as p3d
 
 p3d.load_prc_file('config/engine.prc')
 if os.path.exists(os.path.join('config', 'user.prc')):
     p3d.load_prc_file('config/user.prc')
 
-if 'server' in sys.argv:
+MODE = sys.argv[1] if len(sys.argv) > 1 else 'stand-alone'
+SERVER_FRAME_RATE = 60
+
+if MODE == 'server':
     p3d.load_prc_file_data('', 'window-type none')
 
-import inputmapper
+if MODE == 'bots' and __name__ == '__main__':
+    # main.py bots [port] [host] [count]
+    # Bots are headless clients and need none of the game below
+    import bots
+    bots.run_bots(
+        host=sys.argv[3] if len(sys.argv) > 3 else 'localhost',
+        port=int(sys.argv[2]) if len(sys.argv) > 2 else 9999,
+        count=int(sys.argv[4]) if len(sys.argv) > 4 else 10,
+    )
+    sys.exit()
+
+from direct.showbase.ShowBase import ShowBase
+
+import ecs
 import game_modes
 import network
-from player import *
+from player import CharacterSystem, AiSystem, AnimationSystem
 from effects import EffectSystem
 from physics import PhysicsSystem
+from spatial import SpatialHashSystem
+from streaming import LevelStreamingSystem
 
 
 class Sigurd(ShowBase):
     def __init__(self):
         ShowBase.__init__(self)
 
-        self.render.set_shader_auto()
-        light = p3d.DirectionalLight('sun')
-        light.set_color(p3d.VBase4(1.0, 0.94, 0.84, 1.0))
-        light_np = self.render.attach_new_node(light)
-        light_np.set_hpr(p3d.VBase3(0, -45, 0))
-        self.render.set_light(light_np)
+        # A headless server has nothing to light or take input from
+        self.inputmapper = None
+        if MODE != 'server':
+            self.setup_client()
 
-        light = p3d.DirectionalLight('indirect')
-        light.set_color(p3d.VBase4(0.15, 0.15, 0.15, 1.0))
-        light_np = self.render.attach_new_node(light)
-        light_np.set_hpr(p3d.VBase3(0, 45, 0))
-        self.render.set_light(light_np)
-
-        if base.win:
-            wp = p3d.WindowProperties()
-            wp.set_cursor_hidden(True)
-            wp.set_mouse_mode(p3d.WindowProperties.MRelative)
-            base.win.requestProperties(wp)
-            self.disableMouse()
-
-        self.inputmapper = inputmapper.InputMapper('input.conf')
-
-        self.ecsmanager = ecs.ECSManager()
+        self.ecsmanager = ecs.ECSManager(max_workers=p3d.ConfigVariableInt('ecs-worker-threads', 0).get_value())
+        self.ecsmanager.add_system(SpatialHashSystem())
         self.ecsmanager.add_system(CharacterSystem())
+        self.ecsmanager.add_system(LevelStreamingSystem(is_server=MODE == 'server'))
         self.ecsmanager.add_system(PhysicsSystem())
+        self.ecsmanager.add_system(AnimationSystem())
+        if MODE == 'server':
+            from lagcomp import LagCompensationSystem
+            self.ecsmanager.add_system(LagCompensationSystem())
         self.ecsmanager.add_system(EffectSystem())
         self.ecsmanager.add_system(AiSystem())
 
         port = int(sys.argv[2]) if len(sys.argv) > 2 else 9999
         host = sys.argv[3] if len(sys.argv) > 3 else 'localhost'
-        if len(sys.argv) == 1 or sys.argv[1] == 'stand-alone':
+        if MODE == 'stand-alone':
             is_server = False
             proc = subprocess.Popen([sys.executable, sys.argv[0], 'server', str(port), str(host)])
             def kill_server():
@@ -67,18 +73,23 @@ class Sigurd(ShowBase):
                     proc.terminate()
             atexit.register(kill_server)
             time.sleep(1)
-        elif sys.argv[1] == 'server':
+        elif MODE == 'server':
             is_server = True
 
             # No need to run at full speed
             globalClock.set_mode(p3d.ClockObject.MLimited)
-            globalClock.set_frame_rate(60)
-        elif sys.argv[1] == 'client':
+            globalClock.set_frame_rate(SERVER_FRAME_RATE)
+        elif MODE == 'client':
             is_server = False
         else:
-            raise RuntimeError('Unrecognized mode: {}'.format(sys.argv[1]))
+            raise RuntimeError('Unrecognized mode: {}'.format(MODE))
 
-        self.network_manager = network.NetworkManager(self.ecsmanager, network.PandaTransportLayer, is_server)
+        if p3d.ConfigVariableBool('net-threaded-transport', False).get_value():
+            transport_layer = network.ThreadedPandaTransportLayer
+        else:
+            transport_layer = network.PandaTransportLayer
+        self.network_manager = network.NetworkManager(self.ecsmanager, transport_layer, is_server)
+        atexit.register(self.network_manager.shutdown)
         if is_server:
             self.network_manager.start_server(port)
         else:
@@ -86,7 +97,46 @@ class Sigurd(ShowBase):
 
         self.game_mode = game_modes.ClassicGameMode()
 
+        self.server_report = None
+        if is_server:
+            import governor
+            import metrics
+
+            self.server_report = metrics.ServerReport(self.ecsmanager, self.network_manager)
+            if p3d.ConfigVariableBool('governor-enable', True).get_value():
+                self.server_report.governor = governor.OverloadGovernor(
+                    self.ecsmanager,
+                    self.network_manager,
+                    self.game_mode,
+                    SERVER_FRAME_RATE
+                )
+            report_interval = p3d.ConfigVariableDouble('server-report-interval', 5.0).get_value()
+            if report_interval > 0:
+                def run_report(task):
+                    self.server_report.report()
+                    return task.again
+                self.taskMgr.do_method_later(report_interval, run_report, 'Server Report')
+
+            metrics_port = p3d.ConfigVariableInt('metrics-port', 0).get_value()
+            if metrics_port > 0:
+                metrics_endpoint = metrics.MetricsEndpoint(
+                    self.server_report,
+                    metrics_port,
+                    p3d.ConfigVariableString('metrics-host', '127.0.0.1').get_value(),
+                )
+                atexit.register(metrics_endpoint.shutdown)
+                def refresh_metrics(task):
+                    metrics_endpoint.refresh()
+                    return task.again
+                self.taskMgr.do_method_later(
+                    p3d.ConfigVariableDouble('metrics-refresh-interval', 1.0).get_value(),
+                    refresh_metrics,
+                    'Metrics'
+                )
+
         def run_ecs(task):
+            if self.server_report:
+                self.server_report.tick_stats.begin()
             self.ecsmanager.update(globalClock.get_dt())
             if self.game_mode.is_game_over():
                 print("Game over, restarting")
@@ -96,6 +146,10 @@ class Sigurd(ShowBase):
 
         def run_net(task):
             self.network_manager.update(globalClock.get_dt())
+            if self.server_report:
+                self.server_report.tick_stats.end()
+                if self.server_report.governor:
+                    self.server_report.governor.record(self.server_report.tick_stats.last)
             return task.cont
         self.taskMgr.add(run_net, 'Network')
 
@@ -105,13 +159,60 @@ class Sigurd(ShowBase):
         self.taskMgr.add(run_gamemode, 'Game Mode')
 
         def restart_game():
+            if p3d.ConfigVariableBool('fast-restart', False).get_value() and self.game_mode.fast_restart():
+                return
+
             self.game_mode.end_game()
+            if p3d.ConfigVariableBool('ecs-leak-report', False).get_value():
+                self.ecsmanager.print_leak_report()
             self.game_mode.start_game()
 
         restart_game()
 
+        snapshot_path = p3d.ConfigVariableString('snapshot-path', '').get_value()
+        if is_server and snapshot_path:
+            # Crash recovery and server migration
+            import snapshot
+
+            if os.path.exists(snapshot_path) and p3d.ConfigVariableBool('snapshot-restore', True).get_value():
+                print('Restoring snapshot from', snapshot_path)
+                self.game_mode.load_snapshot(snapshot.read(snapshot_path), owned_players_only=True)
+
+            def autosave(task):
+                snapshot.write(snapshot_path, snapshot.capture(self.ecsmanager, self.network_manager.next_netid))
+                return task.again
+            autosave_interval = p3d.ConfigVariableDouble('snapshot-autosave-interval', 10.0).get_value()
+            self.taskMgr.do_method_later(autosave_interval, autosave, 'Snapshot Autosave')
+
         self.accept('restart-game', restart_game)
         self.accept('quit-up', sys.exit)
+
+        atexit.register(self.ecsmanager.shutdown)
+
+    def setup_client(self):
+        import inputmapper
+
+        self.render.set_shader_auto()
+        light = p3d.DirectionalLight('sun')
+        light.set_color(p3d.VBase4(1.0, 0.94, 0.84, 1.0))
+        light_np = self.render.attach_new_node(light)
+        light_np.set_hpr(p3d.VBase3(0, -45, 0))
+        self.render.set_light(light_np)
+
+        light = p3d.DirectionalLight('indirect')
+        light.set_color(p3d.VBase4(0.15, 0.15, 0.15, 1.0))
+        light_np = self.render.attach_new_node(light)
+        light_np.set_hpr(p3d.VBase3(0, 45, 0))
+        self.render.set_light(light_np)
+
+        if base.win:
+            wp = p3d.WindowProperties()
+            wp.set_cursor_hidden(True)
+            wp.set_mouse_mode(p3d.WindowProperties.MRelative)
+            base.win.requestProperties(wp)
+            self.disableMouse()
+
+        self.inputmapper = inputmapper.InputMapper('input.conf')
         self.accept('aspectRatioChanged', self.cb_resize)
 
     def cb_resize(self):
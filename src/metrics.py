@@ -0,0 +1,263 @@
+import http.server
+import threading
+import time
+
+
+# Upper bounds in seconds of the tick duration histogram buckets
+TICK_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.0167, 0.025, 0.05, 0.1, 0.25)
+
+
+class Histogram(object):
+    # Cumulative counts per bucket, never reset so scrapers can compute rates
+    __slots__ = [
+        'buckets',
+        'counts',
+        'count',
+        'total',
+    ]
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative_counts(self):
+        counts = []
+        running = 0
+        for count in self.counts:
+            running += count
+            counts.append(running)
+        return counts
+
+
+class TickStats(object):
+    __slots__ = [
+        'count',
+        'total',
+        'max',
+        'last',
+        'histogram',
+        '_start',
+    ]
+
+    def __init__(self, histogram=None):
+        self._start = None
+        self.last = 0.0
+        self.histogram = histogram
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def begin(self):
+        self._start = time.perf_counter()
+
+    def end(self):
+        if self._start is not None:
+            self.record(time.perf_counter() - self._start)
+            self._start = None
+
+    def record(self, duration):
+        self.last = duration
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        if self.histogram is not None:
+            self.histogram.observe(duration)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class ServerReport(object):
+    def __init__(self, ecsmanager, network_manager):
+        self.ecsmanager = ecsmanager
+        self.network_manager = network_manager
+        self.tick_histogram = Histogram(TICK_BUCKETS)
+        self.tick_stats = TickStats(self.tick_histogram)
+        self.governor = None
+        self._last_time = time.perf_counter()
+        self._last_bytes_out = 0
+        self._last_bytes_in = 0
+
+    def report(self):
+        now = time.perf_counter()
+        elapsed = max(now - self._last_time, 1e-6)
+        transport_stats = self.network_manager.transport.stats()
+        bytes_out = transport_stats.get('bytes_out', 0)
+        bytes_in = transport_stats.get('bytes_in', 0)
+
+        print('Server: {} connections, {} entities, tick {:.2f}ms mean {:.2f}ms max, {:.1f}KB/s out {:.1f}KB/s in'.format(
+            len(self.network_manager.transport.connections),
+            len(self.ecsmanager.entities),
+            self.tick_stats.mean * 1000,
+            self.tick_stats.max * 1000,
+            (bytes_out - self._last_bytes_out) / elapsed / 1024,
+            (bytes_in - self._last_bytes_in) / elapsed / 1024,
+        ))
+
+        input_stats = self.network_manager.input_stats
+        if input_stats['messages']:
+            print('Input: {} messages, {} inputs dropped, {} recovered from redundancy, {} duplicate messages'.format(
+                input_stats['messages'],
+                input_stats['dropped'],
+                input_stats['recovered'],
+                input_stats['duplicate'],
+            ))
+            input_stats.clear()
+
+        if self.ecsmanager.has_system('PhysicsSystem'):
+            physics = self.ecsmanager.get_system('PhysicsSystem')
+            diagnostics = physics.diagnostics()
+            print('Physics: step {:.2f}ms mean {:.2f}ms max, {} manifolds, {} ray casts, {}/{} characters idle'.format(
+                diagnostics['step_mean_ms'],
+                diagnostics['step_max_ms'],
+                diagnostics['manifolds'],
+                diagnostics['ray_casts'],
+                diagnostics['idle_characters'],
+                diagnostics['characters'],
+            ))
+            physics.step_stats.reset()
+            physics.ray_casts = 0
+
+        self.tick_stats.reset()
+        self._last_time = now
+        self._last_bytes_out = bytes_out
+        self._last_bytes_in = bytes_in
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+class MetricsEndpoint(object):
+    # Serves server metrics in the Prometheus text format. The page is rendered on the main thread by
+    # refresh() and the HTTP thread only ever hands out the last rendered copy.
+    def __init__(self, server_report, port, host='127.0.0.1'):
+        self.server_report = server_report
+        self.ecsmanager = server_report.ecsmanager
+        self.network_manager = server_report.network_manager
+        self.page = b''
+
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                page = endpoint.page
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(page)))
+                self.end_headers()
+                self.wfile.write(page)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='Metrics', daemon=True)
+        self._thread.start()
+        print('Serving metrics on http://{}:{}/metrics'.format(host, self.server.server_address[1]))
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def refresh(self):
+        self.page = self.render().encode('utf-8')
+
+    def render(self):
+        from network import MessageTypes
+
+        lines = []
+
+        def metric(name, kind, doc, samples):
+            lines.append('# HELP {} {}'.format(name, doc))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _labels(**labels) if labels else '', value))
+
+        def message_name(msgid):
+            try:
+                return MessageTypes(msgid).name
+            except ValueError:
+                return str(msgid)
+
+        histogram = self.server_report.tick_histogram
+        samples = [({'le': bound}, count) for bound, count in zip(histogram.buckets, histogram.cumulative_counts())]
+        samples.append(({'le': '+Inf'}, histogram.count))
+        lines.append('# HELP sigurd_tick_duration_seconds Time spent in the ECS and network update of a server tick')
+        lines.append('# TYPE sigurd_tick_duration_seconds histogram')
+        for labels, value in samples:
+            lines.append('sigurd_tick_duration_seconds_bucket{} {}'.format(_labels(**labels), value))
+        lines.append('sigurd_tick_duration_seconds_sum {}'.format(histogram.total))
+        lines.append('sigurd_tick_duration_seconds_count {}'.format(histogram.count))
+
+        ecsmanager = self.ecsmanager
+        metric('sigurd_system_duration_seconds', 'gauge', 'Time each ECS system took in the last tick', [
+            ({'system': name}, duration) for name, duration in sorted(ecsmanager.system_times.items())
+        ])
+        metric('sigurd_entities', 'gauge', 'Entities by lifecycle state', [
+            ({'state': 'active'}, len(ecsmanager.entities)),
+            ({'state': 'pending_destroy'}, len(ecsmanager.destroy_queue)),
+            ({'state': 'pooled'}, len(ecsmanager.entity_pool)),
+        ])
+
+        components = {}
+        for entity in ecsmanager.entities:
+            for typeid, clist in entity._components.items():
+                components[typeid] = components.get(typeid, 0) + len(clist)
+        metric('sigurd_components', 'gauge', 'Active components by typeid', [
+            ({'typeid': typeid}, count) for typeid, count in sorted(components.items())
+        ])
+
+        network_manager = self.network_manager
+        transport = network_manager.transport
+        metric('sigurd_connections', 'gauge', 'Connected clients', [
+            ({}, len(transport.connections)),
+        ])
+        for direction in ('out', 'in'):
+            for unit in ('bytes', 'messages'):
+                counter = getattr(transport, '{}_{}'.format(unit, direction), {})
+                metric('sigurd_network_{}_{}_total'.format(unit, direction), 'counter',
+                       'Network {} {} by message type'.format(unit, 'sent' if direction == 'out' else 'received'), [
+                    ({'message': message_name(msgid)}, count) for msgid, count in sorted(counter.copy().items())
+                ])
+
+        transport_stats = transport.stats()
+        queues = [
+            ({'queue': 'destroy'}, len(ecsmanager.destroy_queue)),
+            ({'queue': 'timers'}, len(ecsmanager.timers)),
+            ({'queue': 'starved_entities'}, sum(
+                state.last_entities_starved for state in network_manager.connection_states.values()
+            )),
+        ]
+        for queue in ('outgoing', 'incoming', 'send'):
+            key = '{}_queue_depth'.format(queue)
+            if key in transport_stats:
+                queues.append(({'queue': 'net_' + queue}, transport_stats[key]))
+        metric('sigurd_queue_depth', 'gauge', 'Items waiting in server queues', queues)
+
+        governor = self.server_report.governor
+        if governor is not None:
+            metric('sigurd_governor_level', 'gauge', 'Load shedding steps currently applied', [
+                ({}, governor.level),
+            ])
+
+        lines.append('')
+        return '\n'.join(lines)
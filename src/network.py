@@ -1,5 +1,8 @@
+import collections
 import enum
 import json
+import threading
+import time
 
 import panda3d.core as p3d
 from direct.distributed.PyDatagram import PyDatagram
@@ -12,55 +15,296 @@ class MessageTypes(enum.IntEnum):
     register_player = 3
     player_id = 4
     player_input = 5
+    server_time = 6
+    heartbeat = 7
+
+
+class ConnectionState(object):
+    __slots__ = [
+        'connection',
+        'entity_netid',
+        'bandwidth',
+        'budget',
+        'priorities',
+        'sent_versions',
+        'bytes_sent',
+        'entities_sent',
+        'entities_starved',
+        'last_bytes_sent',
+        'last_entities_sent',
+        'last_entities_starved',
+        'connected_time',
+    ]
+
+    def __init__(self, connection, bandwidth):
+        self.connection = connection
+        self.entity_netid = 0
+        self.bandwidth = bandwidth
+        self.budget = bandwidth * NetworkManager.max_burst
+        self.priorities = {}
+        self.sent_versions = {}
+        self.bytes_sent = 0
+        self.entities_sent = 0
+        self.entities_starved = 0
+        self.last_bytes_sent = 0
+        self.last_entities_sent = 0
+        self.last_entities_starved = 0
+        self.connected_time = 0.0
 
 
 class NetworkManager(object):
+    # Seconds worth of bandwidth a connection can save up while idle
+    max_burst = 0.25
+
+    # Relative priority of entities by component, the first match wins
+    type_priorities = [
+        ('PLAYER', 3.0),
+        ('CHARACTER', 2.0),
+    ]
+    default_type_priority = 1.0
+    # Raised by the overload governor to shed snapshots. Stale entities are only sent once their accumulated
+    # priority reaches this many snapshot intervals' worth of a changed entity of default type next to the
+    # viewer, so far away and unchanged entities are the first to slow down.
+    shed_intervals = 0
+    changed_priority = 2.0
+    priority_distance = 10.0
+    # Charged against the bandwidth budget for an update the transport has not encoded before
+    estimated_update_size = 64
+
     def __init__(self, ecs, transport_layer, is_server=False):
         self.ecs = ecs
         self.netrole = 'SERVER' if is_server else 'CLIENT'
-        self.transport = transport_layer(self.message_handler)
+        self.transport = transport_layer(self.message_handler, self.connection_lost)
         self.next_netid = 1
         self.server_update_rate = 1/30
-        self.server_update_accum = 0
+        self.client_bandwidth = p3d.ConfigVariableInt('net-client-bandwidth', 64000).get_value()
+        self.connection_states = {}
+        self.entity_versions = {}
+        self.server_tick = 0
+        # On clients, the server frame time of the newest state received
+        self.server_time = 0.0
+        self.server_time_received = 0.0
+        # On the server, counts of player input messages and inputs that were lost, recovered or repeated
+        self.input_stats = collections.Counter()
+        # On clients, (netid, payload) of update_entity messages waiting for apply_entity_updates(), payloads are
+        # JSON text unless the transport already decoded them
+        self.pending_updates = []
+
+        # Snapshots go out from the ECS timer wheel, right after the systems that produced them. A long
+        # frame coalesces missed sends, so the time since the last one is measured in wheel ticks.
+        self._snapshot_timer = None
+        self._last_snapshot_tick = self.ecs.timers.tick
+        if is_server:
+            self._snapshot_timer = self.ecs.timers.every(self.server_update_rate, self._send_snapshots)
 
     def register_entity(self, entity):
         if self.netrole == 'SERVER':
             entity.netid = self.next_netid
             self.next_netid += 1
 
-    def update(self, dt):
-        self.transport.update()
+    def set_connection_entity(self, connection, entity):
+        # The entity a connection controls, used to prioritize updates close to it
+        self._connection_state(connection).entity_netid = entity.netid
+
+    def set_connection_bandwidth(self, connection, bandwidth):
+        self._connection_state(connection).bandwidth = bandwidth
+
+    def _connection_state(self, connection):
+        if connection not in self.connection_states:
+            self.connection_states[connection] = ConnectionState(connection, self.client_bandwidth)
+        return self.connection_states[connection]
+
+    def _type_priority(self, entity):
+        for typeid, type_priority in self.type_priorities:
+            if entity.has_component(typeid):
+                return type_priority
+        return self.default_type_priority
+
+    def _entity_priority(self, entity, changed, pos, viewer_pos):
+        priority = self._type_priority(entity)
 
+        if changed:
+            priority *= self.changed_priority
+
+        if viewer_pos is not None and pos is not None:
+            distance = (pos - viewer_pos).length()
+            priority /= 1.0 + distance / self.priority_distance
+
+        return priority
+
+    def server_now(self):
+        # Current server time, estimated on clients from the last server_time message
         if self.netrole == 'SERVER':
-            self.server_update_accum += dt
-            if self.server_update_accum >= self.server_update_rate:
-                for entity in [i for i in self.ecs.entities if i.netid != 0]:
-                    self.transport.broadcast(MessageTypes.update_entity, {
-                        'netid': entity.netid,
-                        'data': json.dumps(entity.serialize()),
-                    })
-                for netid in self.ecs.removed_entities:
-                    self.transport.broadcast(MessageTypes.remove_entity, {
-                        'netid': netid,
-                    })
-
-                self.server_update_accum = 0
+            return globalClock.get_frame_time()
+        return self.server_time + globalClock.get_frame_time() - self.server_time_received
 
-    def message_handler(self, connection, msgid, data):
-        if msgid == MessageTypes.update_entity:
-            entities = [i for i in self.ecs.entities if i.netid == data['netid']]
-            if len(entities) == 0:
+    def update(self, dt):
+        self.transport.update()
+        self.apply_entity_updates()
+
+    def apply_entity_updates(self):
+        # Decodes everything received since the last call with a single json.loads and looks up each
+        # netid in one map instead of scanning the entity list per message. A transport that decodes on
+        # its own thread hands over payloads that are already decoded.
+        updates = self.pending_updates
+        if not updates:
+            return
+        self.pending_updates = []
+
+        payloads = [payload for _, payload in updates]
+        encoded = [i for i, payload in enumerate(payloads) if isinstance(payload, str)]
+        if encoded:
+            decoded = json.loads('[' + ','.join([payloads[i] for i in encoded]) + ']')
+            for i, payload in zip(encoded, decoded):
+                payloads[i] = payload
+        entities = {i.netid: i for i in self.ecs.entities if i.netid != 0}
+        for (netid, _), data in zip(updates, payloads):
+            entity = entities.get(netid)
+            if entity is None:
                 entity = self.ecs.create_entity()
                 self.register_entity(entity)
-            else:
-                entity = entities[0]
+                entities[netid] = entity
+            entity.update(netid, data)
+
+    def _send_snapshots(self):
+        timers = self.ecs.timers
+        elapsed = (timers.tick - self._last_snapshot_tick) * timers.resolution
+        self._last_snapshot_tick = timers.tick
+        self.server_tick += 1
+        self.transport.broadcast(MessageTypes.server_time, {
+            'time': globalClock.get_frame_time(),
+        })
+        networked = {i.netid: i for i in self.ecs.entities if i.netid != 0}
+
+        # Bump the version of every entity that changed, keeping this tick's delta around. Payloads are left
+        # for the transport to encode when it can do so off of the main thread.
+        encode = not self.transport.encodes_updates
+        deltas = {}
+        for netid, entity in networked.items():
+            data = entity.serialize(dirty_only=True)
+            if data:
+                self.entity_versions[netid] = self.entity_versions.get(netid, 0) + 1
+                deltas[netid] = json.dumps(data, separators=(',', ':')) if encode else data
+        full_payloads = {}
+        min_priority = self.shed_intervals * self.default_type_priority * self.changed_priority * self.server_update_rate
+
+        # Positions are shared by every connection's priorities, look each one up once
+        positions = {
+            netid: entity.get_component('NODEPATH').nodepath.get_pos(base.render)
+            for netid, entity in networked.items()
+            if entity.has_component('NODEPATH')
+        }
+
+        for netid in self.ecs.removed_entities:
+            self.entity_versions.pop(netid, None)
+            self.transport.broadcast(MessageTypes.remove_entity, {
+                'netid': netid,
+            })
+        for connection_state in self.connection_states.values():
+            for netid in self.ecs.removed_entities:
+                connection_state.priorities.pop(netid, None)
+                connection_state.sent_versions.pop(netid, None)
+        self.ecs.removed_entities.clear()
+
+        # A closed connection leaves transport.connections before its disconnect is dispatched, and
+        # connection_lost() drops its state, so the copy below never brings a state back
+        for connection in list(self.transport.connections):
+            state = self._connection_state(connection)
+            state.connected_time += elapsed
+
+            # Updates the transport encoded were charged at an estimated size, settle the difference
+            correction = self.transport.take_size_correction(connection)
+            state.budget -= correction
+            state.bytes_sent += correction
+            state.budget = min(state.budget + state.bandwidth * elapsed, state.bandwidth * self.max_burst)
+
+            viewer_pos = positions.get(state.entity_netid)
+
+            # Accumulate priority for everything this connection has not seen the latest version of
+            stale = []
+            for netid, version in self.entity_versions.items():
+                if state.sent_versions.get(netid, 0) >= version or netid not in networked:
+                    continue
+                priority = self._entity_priority(networked[netid], netid in deltas, positions.get(netid), viewer_pos)
+                state.priorities[netid] = state.priorities.get(netid, 0.0) + priority * elapsed
+                stale.append(netid)
+            stale.sort(key=lambda netid: state.priorities[netid], reverse=True)
+
+            sent = 0
+            bytes_sent = 0
+            for netid in stale:
+                if state.budget <= 0 or state.priorities[netid] < min_priority:
+                    break
+
+                # This tick's delta is only enough if the connection has everything before it
+                version = self.entity_versions[netid]
+                if netid in deltas and state.sent_versions.get(netid, 0) == version - 1:
+                    payload = deltas[netid]
+                else:
+                    if netid not in full_payloads:
+                        data = networked[netid].serialize()
+                        full_payloads[netid] = json.dumps(data, separators=(',', ':')) if encode else data
+                    payload = full_payloads[netid]
+
+                message = {
+                    'netid': netid,
+                    'data': payload,
+                }
+                if isinstance(payload, str):
+                    size = len(payload) + 7
+                else:
+                    size = self.transport.update_sizes.get(netid, self.estimated_update_size) + 7
+                    message['estimated_size'] = size
+                self.transport.send_to(connection, MessageTypes.update_entity, message)
+                state.budget -= size
+                bytes_sent += size
+                sent += 1
+                state.sent_versions[netid] = version
+                state.priorities[netid] = 0.0
+
+            state.last_bytes_sent = bytes_sent
+            state.last_entities_sent = sent
+            state.last_entities_starved = len(stale) - sent
+            state.bytes_sent += bytes_sent
+            state.entities_sent += sent
+            state.entities_starved += len(stale) - sent
+
+
+    def connection_stats(self):
+        stats = {}
+        num_entities = max(len(self.entity_versions), 1)
+        for connection, state in self.connection_states.items():
+            elapsed = max(state.connected_time, 1e-6)
+            stats[connection] = {
+                'bandwidth': state.bandwidth,
+                'bytes_sent': state.bytes_sent,
+                'bytes_per_second': state.bytes_sent / elapsed,
+                'entities_sent': state.entities_sent,
+                'entities_starved': state.entities_starved,
+                'last_entities_starved': state.last_entities_starved,
+                'effective_update_rate': state.entities_sent / elapsed / num_entities,
+            }
+        return stats
+
+    def connection_lost(self, connection):
+        if self.netrole == 'SERVER':
+            state = self.connection_states.pop(connection, None)
+            base.game_mode.handle_disconnect(connection, state.entity_netid if state else 0)
+        else:
+            print('Lost connection to server')
 
-            #print(message.data.value)
-            entity.update(data['netid'], json.loads(data['data']))
+    def message_handler(self, connection, msgid, data):
+        if msgid == MessageTypes.update_entity:
+            self.pending_updates.append((data['netid'], data['data']))
         elif msgid == MessageTypes.remove_entity:
+            # Earlier updates must not bring the entity back after it is removed
+            self.apply_entity_updates()
             entities = [i for i in self.ecs.entities if i.netid == data['netid']]
             if len(entities) > 0 and data['netid'] != 0:
                 self.ecs.remove_entity(entities[0])
+        elif msgid == MessageTypes.server_time:
+            self.server_time = data['time']
+            self.server_time_received = globalClock.get_frame_time()
         else:
             base.game_mode.handle_net_message(connection, msgid, data)
 
@@ -76,10 +320,34 @@ class NetworkManager(object):
     def start_client(self, host, port):
         self.transport.start_client(host, port)
 
+    def shutdown(self):
+        if self._snapshot_timer is not None:
+            self.ecs.timers.cancel(self._snapshot_timer)
+            self._snapshot_timer = None
+        self.transport.shutdown()
+
 
 class BaseTransportLayer(object):
-    def __init__(self, message_handler):
+    # Whether update_entity payloads can be handed over unencoded, for the transport to encode off of the
+    # main thread. Received payloads may then arrive already decoded as well.
+    encodes_updates = False
+
+    def __init__(self, message_handler, disconnect_handler=None):
         self.message_handler = message_handler
+        self.disconnect_handler = disconnect_handler
+        # Last encoded payload length of each netid's update_entity messages
+        self.update_sizes = {}
+
+    def take_size_correction(self, connection):
+        # Bytes the transport encoded for the connection beyond the estimated_size of its updates, since the
+        # last call
+        return 0
+
+    def stats(self):
+        return {}
+
+    def shutdown(self):
+        pass
 
     def update(self):
         raise NotImplementedError()
@@ -98,22 +366,43 @@ class BaseTransportLayer(object):
 
 
 class PandaTransportLayer(BaseTransportLayer):
-    def __init__(self, message_handler):
-        super().__init__(message_handler)
+    io_threads = 0
+
+    def __init__(self, message_handler, disconnect_handler=None):
+        super().__init__(message_handler, disconnect_handler)
 
         self.manager = p3d.QueuedConnectionManager()
         self.listener = None
-        self.reader = p3d.QueuedConnectionReader(self.manager, 0)
-        self.writer = p3d.ConnectionWriter(self.manager, 0)
+        self.reader = p3d.QueuedConnectionReader(self.manager, self.io_threads)
         self.connections = []
 
+        # Every connection gets its own writer thread and queue, a TCP send blocks until the socket takes
+        # the data, so a slow client only ever stalls its own writer. A full queue fails the send.
+        self.writers = {}
+        self.overflowed = set()
+        self.last_received = {}
+        self.last_sent = {}
+        self.timeout = p3d.ConfigVariableDouble('net-connection-timeout', 10.0).get_value()
+        self.heartbeat_interval = p3d.ConfigVariableDouble('net-heartbeat-interval', 1.0).get_value()
+        self.max_send_queue = p3d.ConfigVariableInt('net-max-send-queue', 1024).get_value()
+        self.disconnects = collections.Counter()
+
+        # Traffic counters keyed by msgid
+        self.bytes_out = collections.Counter()
+        self.bytes_in = collections.Counter()
+        self.messages_out = collections.Counter()
+        self.messages_in = collections.Counter()
+
     def _parse_msg_hton(self, msgid, data):
         msg = PyDatagram()
         msg.add_uint8(msgid)
 
         if msgid == MessageTypes.update_entity:
             msg.add_uint32(data['netid'])
-            msg.add_string(data['data'])
+            payload = data['data']
+            if not isinstance(payload, str):
+                payload = json.dumps(payload, separators=(',', ':'))
+            msg.add_string(payload)
         elif msgid == MessageTypes.remove_entity:
             msg.add_uint32(data['netid'])
         elif msgid == MessageTypes.register_player:
@@ -122,8 +411,16 @@ class PandaTransportLayer(BaseTransportLayer):
             msg.add_uint32(data['netid'])
         elif msgid == MessageTypes.player_input:
             msg.add_uint32(data['netid'])
-            msg.add_int8(data['movement_x'])
-            msg.add_string(data['action_set'])
+            msg.add_uint32(data['sequence'])
+            msg.add_float64(data['view_time'])
+            msg.add_uint8(len(data['inputs']))
+            for movement_x, actions in data['inputs']:
+                msg.add_int8(movement_x)
+                msg.add_uint16(actions)
+        elif msgid == MessageTypes.server_time:
+            msg.add_float64(data['time'])
+        elif msgid == MessageTypes.heartbeat:
+            pass
         else:
             raise RuntimeError("Unknown msgid:", msgid)
 
@@ -136,6 +433,7 @@ class PandaTransportLayer(BaseTransportLayer):
 
         if msgid == MessageTypes.update_entity:
             data['netid'] = msg.get_uint32()
+            # Left encoded, clients decode a whole tick of updates at once
             data['data'] = msg.get_string()
         elif msgid == MessageTypes.remove_entity:
             data['netid'] = msg.get_uint32()
@@ -145,16 +443,48 @@ class PandaTransportLayer(BaseTransportLayer):
             data['netid'] = msg.get_uint32()
         elif msgid == MessageTypes.player_input:
             data['netid'] = msg.get_uint32()
-            data['movement_x'] = msg.get_int8()
-            data['action_set'] = msg.get_string()
+            data['sequence'] = msg.get_uint32()
+            data['view_time'] = msg.get_float64()
+            data['inputs'] = [(msg.get_int8(), msg.get_uint16()) for _ in range(msg.get_uint8())]
+        elif msgid == MessageTypes.server_time:
+            data['time'] = msg.get_float64()
+        elif msgid == MessageTypes.heartbeat:
+            pass
         else:
             RuntimeError("Unknown msgid:", msgid)
 
         return msgid, data
 
-    def update(self):
-        # Check for new connections
-        if self.listener and self.listener.new_connection_available():
+    def _add_connection(self, connection):
+        self.connections.append(connection)
+        self.reader.add_connection(connection)
+        writer = p3d.ConnectionWriter(self.manager, 1)
+        writer.set_max_queue_size(self.max_send_queue)
+        self.writers[connection] = writer
+        self.last_received[connection] = time.perf_counter()
+        self.last_sent[connection] = time.perf_counter()
+
+    def close_connection(self, connection, reason):
+        self.last_received.pop(connection, None)
+        self.last_sent.pop(connection, None)
+        self.overflowed.discard(connection)
+        writer = self.writers.pop(connection, None)
+        if writer is None:
+            return
+        print("Closing connection ({}):".format(reason), connection)
+        self.connections.remove(connection)
+        self.reader.remove_connection(connection)
+        self.manager.close_connection(connection)
+        writer.shutdown()
+        self.disconnects[reason] += 1
+        self._connection_closed(connection)
+
+    def _connection_closed(self, connection):
+        if self.disconnect_handler is not None:
+            self.disconnect_handler(connection)
+
+    def _accept_connections(self):
+        while self.listener and self.listener.new_connection_available():
             rendezvous = p3d.PointerToConnection()
             addr = p3d.NetAddress()
             new_conn = p3d.PointerToConnection()
@@ -162,25 +492,88 @@ class PandaTransportLayer(BaseTransportLayer):
             if self.listener.get_new_connection(rendezvous, addr, new_conn):
                 new_conn = new_conn.p()
                 print("New connection:", new_conn)
-                self.connections.append(new_conn)
-                self.reader.add_connection(new_conn)
-
-        # Check for data
+                self._add_connection(new_conn)
+
+    def _check_connections(self):
+        # Drop connections the OS reports as closed, that went quiet or that cannot keep up
+        while self.manager.reset_connection_available():
+            connection = p3d.PointerToConnection()
+            if self.manager.get_reset_connection(connection):
+                self.close_connection(connection.p(), 'reset')
+
+        now = time.perf_counter()
+        for connection in [i for i, t in list(self.last_received.items()) if now - t > self.timeout]:
+            self.close_connection(connection, 'timed out')
+        for connection in list(self.overflowed):
+            self.close_connection(connection, 'send queue full')
+
+        # Keep quiet connections from timing out on the other end
+        idle = [i for i, t in list(self.last_sent.items()) if now - t > self.heartbeat_interval]
+        if idle:
+            self._write(MessageTypes.heartbeat, {}, idle)
+
+    def _read(self):
+        # Yields (connection, msgid, data) for every datagram waiting in the reader
         while self.reader.data_available():
             datagram = p3d.NetDatagram()
 
             if self.reader.get_data(datagram):
                 #print("New data:", datagram)
-                self.message_handler(datagram.get_connection(), *self._parse_msg_ntoh(datagram))
+                msgid, data = self._parse_msg_ntoh(datagram)
+                connection = datagram.get_connection()
+                self.bytes_in[msgid] += datagram.get_length()
+                self.messages_in[msgid] += 1
+                if connection in self.last_received:
+                    self.last_received[connection] = time.perf_counter()
+                if msgid != MessageTypes.heartbeat:
+                    yield connection, msgid, data
+
+    def _write(self, msgid, data, connections):
+        datagram = self._parse_msg_hton(msgid, data)
+        now = time.perf_counter()
+        sent = 0
+        for conn in connections:
+            writer = self.writers.get(conn)
+            if writer is None:
+                continue
+            if not writer.send(datagram, conn):
+                self.overflowed.add(conn)
+                continue
+            self.last_sent[conn] = now
+            sent += 1
+        self.bytes_out[msgid] += datagram.get_length() * sent
+        self.messages_out[msgid] += sent
+
+    def update(self):
+        # Check for new connections
+        self._accept_connections()
+
+        # Check for data
+        for connection, msgid, data in self._read():
+            self.message_handler(connection, msgid, data)
+
+        self._check_connections()
 
     def broadcast(self, msgid, data):
-        datagram = self._parse_msg_hton(msgid, data)
-        for conn in self.connections:
-           self.writer.send(datagram, conn)
+        self._write(msgid, data, self.connections)
 
     def send_to(self, connection, msgid, data):
-        datagram = self._parse_msg_hton(msgid, data)
-        self.writer.send(datagram, connection)
+        self._write(msgid, data, [connection])
+
+    def stats(self):
+        return {
+            'bytes_out': sum(self.bytes_out.values()),
+            'bytes_in': sum(self.bytes_in.values()),
+            'messages_out': sum(self.messages_out.values()),
+            'messages_in': sum(self.messages_in.values()),
+            'send_queue_depth': sum(i.get_current_queue_size() for i in list(self.writers.values())),
+            'disconnects': sum(self.disconnects.values()),
+        }
+
+    def shutdown(self):
+        for writer in list(self.writers.values()):
+            writer.shutdown()
+        self.writers.clear()
 
     def start_server(self, port):
         self.listener = p3d.QueuedConnectionListener(self.manager, 0)
@@ -194,7 +587,186 @@ class PandaTransportLayer(BaseTransportLayer):
 
         if conn:
             print("Connected to server:", conn)
-            self.connections.append(conn)
-            self.reader.add_connection(conn)
+            self._add_connection(conn)
         else:
             raise RuntimeError("Failed to connect to server")
+
+
+class ThreadedPandaTransportLayer(PandaTransportLayer):
+    # Moves datagram (de)serialization, socket I/O and connection bookkeeping (accepting, heartbeats and
+    # closing) off of the main thread. The main thread only queues outgoing messages and dispatches
+    # decoded incoming messages and disconnects, in the order they happened.
+    io_threads = 1
+    encodes_updates = True
+
+    def __init__(self, message_handler, disconnect_handler=None):
+        super().__init__(message_handler, disconnect_handler)
+
+        # deque append/popleft are atomic, so the queues need no extra locking
+        self.outgoing = collections.deque()
+        self.incoming = collections.deque()
+        self.size_corrections = collections.Counter()
+        self._size_lock = threading.Lock()
+        self.send_latency = 0.0
+        self.dispatch_latency = 0.0
+        self.max_outgoing_depth = 0
+        self.max_incoming_depth = 0
+
+        self._wake = threading.Event()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='Network', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            busy = False
+
+            self._accept_connections()
+
+            # The same payload is usually queued for several connections, encode it once
+            encoded = {}
+            while self.outgoing:
+                busy = True
+                queued_time, connection, msgid, data = self.outgoing.popleft()
+                if msgid == MessageTypes.update_entity and not isinstance(data['data'], str):
+                    data = self._encode_update(connection, data, encoded)
+                self._write(msgid, data, [connection] if connection is not None else list(self.connections))
+                self.send_latency = self._smooth(self.send_latency, time.perf_counter() - queued_time)
+            encoded.clear()
+
+            received = list(self._read())
+            if received:
+                busy = True
+                self._decode_updates(received)
+                received_time = time.perf_counter()
+                for connection, msgid, data in received:
+                    self.incoming.append((received_time, connection, msgid, data))
+                self.max_incoming_depth = max(self.max_incoming_depth, len(self.incoming))
+
+            self._check_connections()
+
+            if not busy:
+                self._wake.wait(0.001)
+                self._wake.clear()
+
+    @staticmethod
+    def _smooth(average, sample):
+        return average + (sample - average) * 0.1
+
+    def _encode_update(self, connection, data, encoded):
+        payload = data['data']
+        # Holding on to the payload keeps its id from being reused while the cache is alive
+        _, text = encoded.setdefault(id(payload), (payload, json.dumps(payload, separators=(',', ':'))))
+        size = len(text) + 7
+        self.update_sizes[data['netid']] = len(text)
+        if connection is not None:
+            with self._size_lock:
+                self.size_corrections[connection] += size - data.get('estimated_size', size)
+        return {
+            'netid': data['netid'],
+            'data': text,
+        }
+
+    def _decode_updates(self, received):
+        # Like NetworkManager.apply_entity_updates(), one json.loads for everything read in this pass
+        updates = [data for _, msgid, data in received if msgid == MessageTypes.update_entity]
+        if not updates:
+            return
+        payloads = json.loads('[' + ','.join([data['data'] for data in updates]) + ']')
+        for data, payload in zip(updates, payloads):
+            data['data'] = payload
+
+    def take_size_correction(self, connection):
+        with self._size_lock:
+            return self.size_corrections.pop(connection, 0)
+
+    def _connection_closed(self, connection):
+        # Reported through the incoming queue, after any messages that arrived before the close
+        with self._size_lock:
+            self.size_corrections.pop(connection, None)
+        self.incoming.append((time.perf_counter(), connection, None, None))
+
+    def _queue(self, connection, msgid, data):
+        self.outgoing.append((time.perf_counter(), connection, msgid, data))
+        self.max_outgoing_depth = max(self.max_outgoing_depth, len(self.outgoing))
+        self._wake.set()
+
+    def update(self):
+        # Only dispatch what has arrived so far so a flood cannot starve the tick
+        for _ in range(len(self.incoming)):
+            received_time, connection, msgid, data = self.incoming.popleft()
+            if msgid is None:
+                if self.disconnect_handler is not None:
+                    self.disconnect_handler(connection)
+                continue
+            self.dispatch_latency = self._smooth(self.dispatch_latency, time.perf_counter() - received_time)
+            self.message_handler(connection, msgid, data)
+
+    def broadcast(self, msgid, data):
+        self._queue(None, msgid, data)
+
+    def send_to(self, connection, msgid, data):
+        self._queue(connection, msgid, data)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'outgoing_queue_depth': len(self.outgoing),
+            'incoming_queue_depth': len(self.incoming),
+            'max_outgoing_queue_depth': self.max_outgoing_depth,
+            'max_incoming_queue_depth': self.max_incoming_depth,
+            'send_latency_ms': self.send_latency * 1000,
+            'dispatch_latency_ms': self.dispatch_latency * 1000,
+        })
+        return stats
+
+    def shutdown(self):
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+        super().shutdown()
+
+
+def player_input_message(netid, sequence, inputs, view_time=0.0):
+    # inputs are (movement_x, actions) pairs, oldest first, with the last one numbered sequence.
+    # view_time is the server time of the state the client was looking at, used for lag compensation.
+    return {
+        'netid': netid,
+        'sequence': sequence,
+        'inputs': [(int(movement_x), actions) for movement_x, actions in inputs],
+        'view_time': view_time,
+    }
+
+
+class InputSender(object):
+    # Sends player input when it changes or at a fixed rate otherwise, repeating the last few
+    # inputs in every message so a lost message does not lose an action
+    def __init__(self, network_manager, send_rate=None, redundancy=None):
+        if send_rate is None:
+            send_rate = p3d.ConfigVariableDouble('input-send-rate', 20.0).get_value()
+        if redundancy is None:
+            redundancy = p3d.ConfigVariableInt('input-redundancy', 3).get_value()
+
+        self.network_manager = network_manager
+        self.send_interval = 1.0 / send_rate
+        self.history = collections.deque(maxlen=max(redundancy, 1))
+        self.sequence = 0
+        self.timer = 0.0
+        self.last_sent = None
+
+    def update(self, dt, netid, movement_x, actions):
+        # Returns True if the input was sent
+        self.timer += dt
+        current = (int(movement_x), actions)
+        if current == self.last_sent and not actions and self.timer < self.send_interval:
+            return False
+
+        self.sequence += 1
+        self.history.append(current)
+        self.network_manager.broadcast(
+            MessageTypes.player_input,
+            player_input_message(netid, self.sequence, self.history, self.network_manager.server_time)
+        )
+        self.timer = 0.0
+        self.last_sent = current
+        return True
@@ -1,7 +1,22 @@
+import time
+import weakref
+
 import panda3d.core as p3d
 import panda3d.bullet as bullet
 
 import ecs
+import metrics
+
+
+# Collision groups, these rely on bullet-filter-algorithm being set to groups-mask (see engine.prc)
+GROUP_STATIC = 0
+GROUP_CHARACTER = 1
+GROUP_HITBOX = 2
+
+
+def _detach_node(node):
+    for i in range(node.get_num_parents() - 1, -1, -1):
+        node.get_parent(i).remove_child(node)
 
 
 class HitResult(object):
@@ -11,7 +26,14 @@ class HitResult(object):
         self.node = bullet_hit.get_node()
         self.t = bullet_hit.get_hit_fraction()
         self.triangle_index = bullet_hit.get_triangle_index()
-        self.component = self.node.get_python_tag('component')
+
+        # Only weakly reference the component so stored hits cannot keep it alive
+        component = self.node.get_python_tag('component')
+        self._component = weakref.ref(component) if component is not None else None
+
+    @property
+    def component(self):
+        return self._component() if self._component else None
 
     def __repr__(self):
         return '<HitResult position:{} normal:{} node:{} t:{} triangle_index:{}'.format(
@@ -28,19 +50,29 @@ class HitBoxComponent(ecs.Component):
         'physics_node',
     ]
     typeid = 'PHY_HITBOX'
+    poolable = True
+
+    # Also used by lag compensation to test against past hitbox positions
+    half_extents = (0.25, 0.25, 0.8)
+    offset = (0.0, 0.0, 0.9)
 
     def __init__(self):
         super().__init__()
-        xform_state = p3d.TransformState.make_pos(p3d.LVector3f(0, 0, 0.9))
-        shape = bullet.BulletBoxShape(p3d.LVector3f(0.25, 0.25, 0.8))
+        xform_state = p3d.TransformState.make_pos(p3d.LVector3f(*self.offset))
+        shape = bullet.BulletBoxShape(p3d.LVector3f(*self.half_extents))
         self.physics_node = bullet.BulletGhostNode('HitBox')
         self.physics_node.add_shape(shape, xform_state)
+        self.physics_node.set_into_collide_mask(p3d.BitMask32.bit(GROUP_HITBOX))
+        self.reset()
+
+    def reset(self):
         self.physics_node.set_python_tag('component', self)
 
     def cleanup(self):
         self.physics_node.clear_python_tag('component')
         psys = base.ecsmanager.get_system('PhysicsSystem')
         psys.physics_world.remove(self.physics_node)
+        _detach_node(self.physics_node)
 
 
 class StaticPhysicsMeshComponent(ecs.Component):
@@ -60,6 +92,7 @@ class StaticPhysicsMeshComponent(ecs.Component):
         self.physics_node = bullet.BulletRigidBodyNode('StaticMesh')
         xform_state = p3d.TransformState.make_pos(offset)
         self.physics_node.add_shape(shape, xform_state)
+        self.physics_node.set_into_collide_mask(p3d.BitMask32.bit(GROUP_STATIC))
         self.physics_node.set_python_tag('component', self)
 
     def cleanup(self):
@@ -71,8 +104,10 @@ class StaticPhysicsMeshComponent(ecs.Component):
 class CharacterPhysicsComponent(ecs.Component):
     __slots__ = [
         'physics_node',
+        '_movement',
     ]
     typeid = 'PHY_CHARACTER'
+    poolable = True
 
     def __init__(self):
         super().__init__()
@@ -83,20 +118,61 @@ class CharacterPhysicsComponent(ecs.Component):
 
         step_height = 0.4
         self.physics_node = bullet.BulletCharacterControllerNode(shape, step_height, 'Character')
-        self.physics_node.set_python_tag('component', self)
 
         self.physics_node.set_jump_speed(30)
         self.physics_node.set_gravity(98)
+        self.physics_node.set_into_collide_mask(p3d.BitMask32.bit(GROUP_CHARACTER))
+        self._movement = None
+        self.reset()
+
+    def reset(self):
+        self.physics_node.set_python_tag('component', self)
+        self.set_movement(p3d.LVector3f(0, 0, 0))
+        self.physics_node.set_angular_movement(0)
+        self.physics_node.set_transform(p3d.TransformState.make_identity())
 
     def cleanup(self):
         self.physics_node.clear_python_tag('component')
         psys = base.ecsmanager.get_system('PhysicsSystem')
         psys.physics_world.remove(self.physics_node)
+        self.physics_node.remove_all_children()
+        _detach_node(self.physics_node)
+
+    def set_movement(self, movement):
+        # Only hand Bullet a new velocity when it changes, idle characters are left alone
+        if self._movement is None or movement != self._movement:
+            self.physics_node.set_linear_movement(movement, is_local=False)
+            self._movement = p3d.LVector3f(movement)
+
+    @property
+    def is_idle(self):
+        return not self._movement.length_squared() and self.physics_node.is_on_ground()
+
+    def snapshot(self):
+        d = super().snapshot()
+        if self.physics_node.get_num_parents():
+            d['position'] = list(p3d.NodePath(self.physics_node).get_pos(base.render))
+        else:
+            d['position'] = list(self.entity.get_component('NODEPATH').nodepath.get_pos(base.render))
+        return d
+
+    def restore(self, data):
+        self.set_movement(p3d.LVector3f(0, 0, 0))
+        if self.physics_node.get_num_parents():
+            p3d.NodePath(self.physics_node).set_pos(base.render, p3d.LVector3f(*data['position']))
+        else:
+            # PhysicsSystem.init_components() places the character at the entity's NodePath
+            self.entity.get_component('NODEPATH').nodepath.set_pos(base.render, p3d.LVector3f(*data['position']))
 
 
 class PhysicsSystem(ecs.System):
     __slots__ = [
         'physics_world',
+        'max_substeps',
+        'fixed_step',
+        'step_stats',
+        'last_step_time',
+        'ray_casts',
     ]
 
     component_types = [
@@ -105,8 +181,30 @@ class PhysicsSystem(ecs.System):
         'PHY_CHARACTER',
     ]
 
+    # Stepping the world moves character nodes, Bullet releases the GIL while it runs
+    reads = ('PHY_HITBOX', 'PHY_STATICMESH', 'PHY_CHARACTER', 'NODEPATH', 'PHYSICS_WORLD')
+    writes = ('PHY_HITBOX', 'PHY_STATICMESH', 'PHY_CHARACTER', 'NODEPATH', 'PHYSICS_WORLD')
+    uses_components = False
+
+    # Pairs of collision groups that interact, hitboxes are only ever ray cast against
+    collision_pairs = [
+        (GROUP_STATIC, GROUP_CHARACTER),
+        (GROUP_CHARACTER, GROUP_CHARACTER),
+    ]
+
     def __init__(self):
         self.physics_world = bullet.BulletWorld()
+        self.max_substeps = p3d.ConfigVariableInt('physics-max-substeps', 1).get_value()
+        self.fixed_step = 1.0 / p3d.ConfigVariableDouble('physics-step-rate', 60.0).get_value()
+        self.step_stats = metrics.TickStats()
+        self.last_step_time = 0.0
+        self.ray_casts = 0
+
+        groups = (GROUP_STATIC, GROUP_CHARACTER, GROUP_HITBOX)
+        for group_a in groups:
+            for group_b in groups:
+                enable = (group_a, group_b) in self.collision_pairs or (group_b, group_a) in self.collision_pairs
+                self.physics_world.set_group_collision_flag(group_a, group_b, enable)
 
         phydebug = bullet.BulletDebugNode('Physics Debug')
         phydebug.show_wireframe(True)
@@ -116,12 +214,6 @@ class PhysicsSystem(ecs.System):
         # phydebugnp.show()
         self.physics_world.set_debug_node(phydebug)
 
-        def update_physics(task):
-            dt = globalClock.getDt()
-            self.physics_world.do_physics(dt)
-            return task.cont
-        base.taskMgr.add(update_physics, 'Physics')
-
     def init_components(self, dt, components):
         for hit_box in components.get('PHY_HITBOX', []):
             np_component = hit_box.entity.get_component('NODEPATH')
@@ -143,8 +235,30 @@ class PhysicsSystem(ecs.System):
 
 
 
+    def update(self, dt, components):
+        start = time.perf_counter()
+        self.physics_world.do_physics(dt, self.max_substeps, self.fixed_step)
+        self.last_step_time = time.perf_counter() - start
+        self.step_stats.record(self.last_step_time)
+
+    def diagnostics(self):
+        world = self.physics_world
+        characters = [i[0] for i in base.ecsmanager.query(('PHY_CHARACTER',))]
+        return {
+            'rigid_bodies': world.get_num_rigid_bodies(),
+            'ghosts': world.get_num_ghosts(),
+            'characters': world.get_num_characters(),
+            'idle_characters': len([i for i in characters if i.is_idle]),
+            'manifolds': world.get_num_manifolds(),
+            'ray_casts': self.ray_casts,
+            'step_mean_ms': self.step_stats.mean * 1000,
+            'step_max_ms': self.step_stats.max * 1000,
+            'scene_nodes': base.render.count_num_descendants(),
+        }
+
     def ray_cast(self, from_pos, to_pos, all_hits=False, mask=None):
         hits = []
+        self.ray_casts += 1
 
         # Draw debug lines
         # lineseg = p3d.LineSegs('debug ray')
@@ -155,14 +269,14 @@ class PhysicsSystem(ecs.System):
         # base.render.attach_new_node(debug_line)
 
         if all_hits:
-            if mask:
+            if mask is not None:
                 bhits = self.physics_world.ray_test_all(from_pos, to_pos, mask)
             else:
                 bhits = self.physics_world.ray_test_all(from_pos, to_pos)
             for bhit in bhits.get_hits():
                 hits.append(HitResult(bhit))
         else:
-            if mask:
+            if mask is not None:
                 bhit = self.physics_world.ray_test_closest(from_pos, to_pos, mask)
             else:
                 bhit = self.physics_world.ray_test_closest(from_pos, to_pos)
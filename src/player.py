@@ -4,38 +4,75 @@ import json
 import os
 import collections
 
-from direct.actor.Actor import Actor
 from direct.showbase.DirectObject import DirectObject
 import panda3d.core as p3d
 
 import ecs
 import effects
+from actions import Actions
+from physics import GROUP_STATIC
+
+
+TRACKS = ['track_one', 'track_two', 'track_three', 'track_four']
+
+
+_json_cache = {}
 
 
 def clamp(value, lower, upper):
     return max(min(value, upper), lower)
 
 
+def _load_json(path):
+    # Chassis and track data never change at runtime, so only parse them once
+    if path not in _json_cache:
+        with open(path) as f:
+            _json_cache[path] = json.load(f)
+    return _json_cache[path]
+
+
 class NodePathComponent(ecs.Component):
     __slots__ = [
         'nodepath',
-        '_modelpath'
+        '_modelpath',
+        '_last_transform',
     ]
 
     typeid = 'NODEPATH'
+    poolable = True
 
     def __init__(self, modelpath=None):
         super().__init__()
         self.synchronize = True
-        self._modelpath = modelpath if modelpath else ''
+        self.nodepath = None
+        self._modelpath = ''
+        self.reset(modelpath)
+
+    def reset(self, modelpath=None):
         if modelpath is not None:
             self.nodepath = base.loader.loadModel(modelpath)
-        else:
+        elif self.nodepath is None or self._modelpath:
             self.nodepath = p3d.NodePath(p3d.PandaNode('node'))
+        self._modelpath = modelpath if modelpath else ''
+        self._last_transform = None
 
-    def __del__(self):
-        super().__del__()
-        self.nodepath.remove_node()
+    def cleanup(self):
+        if self._modelpath:
+            self.nodepath.remove_node()
+        else:
+            # Keep the plain node around so it can be reused
+            self.nodepath.get_children().detach()
+            self.nodepath.detach_node()
+            self.nodepath.clear_transform()
+
+    def is_dirty(self):
+        # The net transform is cached by Panda, so comparing it is much cheaper than serializing
+        return self._dirty or self.nodepath.get_net_transform() != self._last_transform
+
+    def clear_dirty(self):
+        # Only the dirty pass moves the baseline, full sends to new connections must not hide a move
+        super().clear_dirty()
+        self._last_transform = self.nodepath.get_net_transform()
 
     def serialize(self):
         d = super().serialize()
@@ -46,53 +83,246 @@ class NodePathComponent(ecs.Component):
         return d
 
     def update(self, cdata):
-        self.nodepath.set_pos(base.render, p3d.LVector3(*cdata['position']))
-        self.nodepath.set_hpr(base.render, p3d.LVector3(*cdata['rotation']))
-        self.nodepath.reparent_to(base.ecsmanager.space.get_component('NODEPATH').nodepath)
+        # The space node sits at the origin of render, so the server's render-relative transform can
+        # be written as a local one
+        nodepath = self.nodepath
+        if not nodepath.has_parent():
+            nodepath.reparent_to(base.ecsmanager.space.get_component('NODEPATH').nodepath)
+        position = cdata['position']
+        rotation = cdata['rotation']
+        nodepath.set_pos_hpr(position[0], position[1], position[2], rotation[0], rotation[1], rotation[2])
+
+    def restore(self, data):
+        spacenp = base.ecsmanager.space.get_component('NODEPATH').nodepath
+        if not self.nodepath.has_parent():
+            self.nodepath.reparent_to(spacenp)
 
+        # Nodes parented to a physics node get their position from the physics component
+        if self.nodepath.get_parent() == spacenp:
+            self.nodepath.set_pos(base.render, p3d.LVector3(*data['position']))
+        self.nodepath.set_hpr(base.render, p3d.LVector3(*data['rotation']))
 
-class WeaponComponent(ecs.UniqueComponent):
+    @classmethod
+    def snapshot_args(cls, data):
+        return (data['modelpath'] or None,)
+
+
+AnimState = collections.namedtuple('AnimState', 'anim start_time rate loop from_frame to_frame blend')
+NO_ANIM = AnimState(None, 0.0, 0.0, False, 0, None, None)
+
+_anim_names_cache = {}
+
+# Poses applied to actors and ones skipped because the actor was culled, reset every frame by AnimationSystem
+anim_counters = collections.Counter()
+
+
+class AnimatedComponent(ecs.UniqueComponent):
+    # Replicates what the actor is doing (an AnimState) rather than its current frame. Snapshots only
+    # carry a new state on transitions and clients play the animation locally from its start time.
     __slots__ = [
         'name',
         'actor',
-        'range',
-        'has_hit',
+        'anim_state',
+        'anim_culled',
+        '_pending_anim',
+        '_anim_stale',
     ]
-    typeid = 'WEAPON'
 
     def __init__(self, name=''):
         super().__init__()
-        self.name = name
-        self.actor = None
-        self.range = 1.0
-        self.has_hit = False
         self.synchronize = True
+        self.actor = None
+        self.name = ''
+        self.reset(name)
 
-    def __del__(self):
-        super().__del__()
-        self.actor.remove_node()
+    def reset(self, name=''):
+        # Keep the loaded actor if the same model is requested again
+        if self.actor and name != self.name:
+            self.actor.cleanup()
+            self.actor.remove_node()
+            self.actor = None
+        self.name = name
+        self.anim_state = NO_ANIM
+        self.anim_culled = False
+        self._pending_anim = None
+        self._anim_stale = False
+
+    def cleanup(self):
+        if self.actor:
+            self.actor.stop()
+            self.actor.detach_node()
+
+    def anim_names(self):
+        # Animations are sent as indices into this list, it is the same on the server and clients
+        key = (self.typeid, self.name)
+        if key not in _anim_names_cache:
+            _anim_names_cache[key] = sorted(self.actor.getAnimNames())
+        return _anim_names_cache[key]
+
+    def set_anim_state(self, state):
+        if state != self.anim_state:
+            self.anim_state = state
+            self.apply_anim_state()
+            self.mark_dirty()
+
+    def pose(self, anim_name, frame):
+        self.set_anim_state(AnimState(anim_name, 0.0, 0.0, False, frame, None, None))
+
+    def play(self, anim_name, fromFrame=0, toFrame=None, rate=1.0, loop=False):
+        self.set_anim_state(AnimState(
+            anim_name, base.network_manager.server_now(), rate, loop, fromFrame, toFrame, None
+        ))
+
+    def blend_poses(self, weights, frame=0):
+        # Weights are quantized so a blend that changes every frame is not sent every snapshot
+        blend = tuple(sorted((anim, round(weight, 1)) for anim, weight in weights.items()))
+        self.set_anim_state(AnimState(None, 0.0, 0.0, False, frame, None, blend))
+
+    def set_anim_culled(self, culled):
+        # Culled actors keep their state, it is applied once they are visible again
+        if culled == self.anim_culled:
+            return
+        self.anim_culled = culled
+        if not culled and self._anim_stale:
+            self.apply_anim_state()
+
+    def expected_frame(self, now):
+        state = self.anim_state
+        if not state.rate:
+            return state.from_frame
+
+        control = self.actor.getAnimControl(state.anim)
+        to_frame = state.to_frame if state.to_frame is not None else control.get_num_frames() - 1
+        frames = max(now - state.start_time, 0.0) * state.rate * self.actor.getBaseFrameRate(state.anim)
+        if state.loop:
+            return state.from_frame + frames % (to_frame - state.from_frame + 1)
+        return min(state.from_frame + frames, to_frame)
+
+    def apply_anim_state(self, now=None):
+        actor = self.actor
+        state = self.anim_state
+        if actor is None:
+            return
+        if self.anim_culled:
+            self._anim_stale = True
+            anim_counters['deferred'] += 1
+            return
+        self._anim_stale = False
+        anim_counters['poses'] += 1
+
+        if state.blend:
+            actor.enableBlend()
+            for anim_name, weight in state.blend:
+                actor.setControlEffect(anim_name, weight)
+                actor.pose(anim_name, state.from_frame)
+            return
+
+        actor.disableBlend()
+        if state.anim is None:
+            actor.stop()
+        elif not state.rate:
+            actor.pose(state.anim, state.from_frame)
+        else:
+            if now is None:
+                now = base.network_manager.server_now()
+            control = actor.getAnimControl(state.anim)
+            to_frame = state.to_frame if state.to_frame is not None else control.get_num_frames() - 1
+            control.set_play_rate(state.rate)
+            control.pose(int(self.expected_frame(now)))
+            if state.loop:
+                control.loop(False, state.from_frame, to_frame)
+            elif control.get_frame() < to_frame:
+                control.play(control.get_frame(), to_frame)
+
+    def anim_drift(self, now):
+        # How many frames the local animation is away from where the server says it should be
+        state = self.anim_state
+        if self.actor is None or self.anim_culled or state.anim is None or not state.rate:
+            return 0.0
+
+        control = self.actor.getAnimControl(state.anim)
+        drift = abs(control.get_frame() - self.expected_frame(now))
+        if state.loop:
+            to_frame = state.to_frame if state.to_frame is not None else control.get_num_frames() - 1
+            drift = min(drift, to_frame - state.from_frame + 1 - drift)
+        return drift
 
     def serialize(self):
         d = super().serialize()
         d['name'] = self.name
-        d['anim_name'] = self.actor.getCurrentAnim()
-        d['anim_frame'] = self.actor.getCurrentFrame(d['anim_name'])
+
+        state = self.anim_state
+        d['anim'] = [
+            self.anim_names().index(state.anim) if state.anim is not None else -1,
+            state.start_time,
+            state.rate,
+            state.loop,
+            state.from_frame,
+            state.to_frame,
+        ]
+        if state.blend:
+            names = self.anim_names()
+            d['blend'] = [[names.index(anim_name), weight] for anim_name, weight in state.blend]
         return d
 
     def update(self, cdata):
         self.name = cdata['name']
-        if self.actor:
-            self.actor.pose(cdata['anim_name'], cdata['anim_frame'])
+        if self.actor is None:
+            # Applied by CharacterSystem once the actor is loaded
+            self._pending_anim = cdata
+            return
+
+        names = self.anim_names()
+        anim_id, start_time, rate, loop, from_frame, to_frame = cdata['anim']
+        blend = None
+        if 'blend' in cdata:
+            blend = tuple((names[anim_id], weight) for anim_id, weight in cdata['blend'])
+        self.anim_state = AnimState(
+            names[anim_id] if anim_id >= 0 else None,
+            start_time,
+            rate,
+            loop,
+            from_frame,
+            to_frame,
+            blend,
+        )
+        self.apply_anim_state()
+
+    def apply_pending(self):
+        if self._pending_anim is not None:
+            cdata = self._pending_anim
+            self._pending_anim = None
+            self.update(cdata)
+        else:
+            self.apply_anim_state()
+
+    @classmethod
+    def snapshot_args(cls, data):
+        return (data['name'],)
+
+
+class WeaponComponent(AnimatedComponent):
+    __slots__ = [
+        'range',
+        'has_hit',
+    ]
+    typeid = 'WEAPON'
+    poolable = True
+
+    def reset(self, name=''):
+        super().reset(name)
+        self.range = 1.0
+        self.has_hit = False
 
 
 class CharacterComponent(ecs.UniqueComponent):
     __slots__ = [
-        'speed',
         'movement',
         'mesh_name',
+        'chassis_name',
         '_chassis',
         'level',
-        'action_set',
+        'actions',
         'attack_move_target',
         'target_entity_guid',
         'track_one',
@@ -101,35 +331,82 @@ class CharacterComponent(ecs.UniqueComponent):
         'track_four',
         'current_health',
         'recoil_duration',
+        'recoil_start',
         'recoil_timer',
     ]
 
     typeid = 'CHARACTER'
+    poolable = True
 
     def __init__(self, chassis, mesh=None):
         super().__init__()
         self.movement = p3d.LVector3f(0, 0, 0)
+        self.reset(chassis, mesh)
+
+    def reset(self, chassis, mesh=None):
+        self.movement.set(0, 0, 0)
         self.mesh_name = mesh
 
         self.level = 1
-        with open(os.path.join('chassis', chassis) + '.json') as f:
-            self._chassis = json.load(f)
+        self.chassis_name = chassis
+        self._chassis = _load_json(os.path.join('chassis', chassis) + '.json')
 
-        self.action_set = set()
+        self.actions = 0
 
-        for t in ['track_one', 'track_two', 'track_three', 'track_four']:
-            with open(os.path.join('tracks', t) + '.json') as f:
-                track_data = json.load(f)
+        for t in TRACKS:
+            track_data = _load_json(os.path.join('tracks', t) + '.json')
             track_entity = base.ecsmanager.create_entity()
             for component_data in track_data['components']:
-                component = getattr(effects, component_data['name'] + 'EffectComponent')(component_data['args'])
-                track_entity.add_component(component)
+                component_class = getattr(effects, component_data['name'] + 'EffectComponent')
+                track_entity.add_component(base.ecsmanager.acquire_component(component_class, component_data['args']))
             setattr(self, t, track_entity)
 
         self.current_health = self.health if self._chassis else None
 
         self.recoil_duration = 0.35
-        self.recoil_timer = self.recoil_duration + 1.0
+        self.recoil_start = 0.0
+        self.recoil_timer = None
+
+    def start_recoil(self):
+        timers = base.ecsmanager.timers
+        self.stop_recoil()
+        self.recoil_start = timers.time
+        self.recoil_timer = timers.schedule(self.recoil_duration, self._end_recoil)
+
+    def stop_recoil(self):
+        if self.recoil_timer is not None:
+            base.ecsmanager.timers.cancel(self.recoil_timer)
+            self.recoil_timer = None
+
+    def _end_recoil(self):
+        self.recoil_timer = None
+
+    def snapshot(self):
+        d = super().snapshot()
+        d['chassis'] = self.chassis_name
+        d['mesh'] = self.mesh_name
+        d['level'] = self.level
+        d['current_health'] = self.current_health
+        return d
+
+    def restore(self, data):
+        self.level = data['level']
+        self.current_health = data['current_health']
+        self.movement.set(0, 0, 0)
+        self.actions = 0
+        self.stop_recoil()
+
+    @classmethod
+    def snapshot_args(cls, data):
+        return (data['chassis'], data['mesh'])
+
+    def cleanup(self):
+        self.stop_recoil()
+        for t in TRACKS:
+            track_entity = getattr(self, t)
+            if track_entity is not None:
+                base.ecsmanager.remove_entity(track_entity)
+                setattr(self, t, None)
 
     @property
     def health(self):
@@ -164,46 +441,38 @@ class CharacterComponent(ecs.UniqueComponent):
         return self._chassis['magic_resistance'] + self._chassis['magic_resistance_per_lvl'] * self.level - 1
 
 
-class ActorComponent(ecs.UniqueComponent):
+class ActorComponent(AnimatedComponent):
     __slots__ = [
-        'name',
-        'actor',
         'anim_controls',
     ]
     typeid = 'ACTOR'
+    poolable = True
 
     def __init__(self, name=''):
-        super().__init__()
-        self.synchronize = True
-        self.name = name
-        self.actor = None
         self.anim_controls = {}
+        super().__init__(name)
 
-    def __del__(self):
-        super().__del__()
-        if self.actor:
-            self.actor.remove_node()
-
-    def serialize(self):
-        d = super().serialize()
-        d['name'] = self.name
-        d['anim_name'] = self.actor.getCurrentAnim()
-        d['anim_frame'] = self.actor.getCurrentFrame(d['anim_name'])
-        return d
-
-    def update(self, cdata):
-        self.name = cdata['name']
-        if self.actor:
-            self.actor.pose(cdata['anim_name'], cdata['anim_frame'])
+    def reset(self, name=''):
+        super().reset(name)
+        self.anim_controls.clear()
 
 
 class PlayerComponent(ecs.UniqueComponent):
     __slots__ = [
+        'view_time',
+        'last_input_sequence',
     ]
     typeid = 'PLAYER'
+    poolable = True
 
+    def __init__(self):
+        super().__init__()
+        self.reset()
 
-Attack = collections.namedtuple('Attack', 'damage')
+    def reset(self):
+        # Server time of the state this player last saw, 0 when unknown
+        self.view_time = 0.0
+        self.last_input_sequence = 0
 
 
 class CharacterSystem(ecs.System):
@@ -213,85 +482,168 @@ class CharacterSystem(ecs.System):
         'WEAPON',
     ]
 
+    reads = ('ACTOR', 'CHARACTER', 'WEAPON', 'NODEPATH', 'PLAYER', 'PHY_CHARACTER', 'PHY_HITBOX',
+             'PHYSICS_WORLD', 'SPATIAL_HASH')
+    writes = ('ACTOR', 'CHARACTER', 'WEAPON', 'NODEPATH', 'PHY_CHARACTER', 'PHY_HITBOX', 'EFFECT', 'ENTITIES',
+              'EVENTS')
+    uses_components = False
+
+    # HIT is a weapon connecting, DAMAGE a change in health and DEATH a character running out of it.
+    # Sources are -1 when nothing caused the event.
+    event_types = {
+        'HIT': (('source', ecs.GUID), ('target', ecs.GUID)),
+        'DAMAGE': (('source', ecs.GUID), ('target', ecs.GUID), ('amount', 'f')),
+        'DEATH': (('target', ecs.GUID), ('source', ecs.GUID)),
+    }
+    event_handlers = {
+        'DAMAGE': 'apply_damage',
+        'DEATH': 'resolve_deaths',
+    }
+
     def __init__(self):
         super().__init__()
-        self._attack_queues = {}
+        self.attack_range = 1000.0
+        # Distance from the attack ray within which a character could be hit
+        self.attack_corridor = 1.5
+        self.attack_damage = 1
+        self.deaths = 0
+
+    def diagnostics(self):
+        return {
+            'deaths': self.deaths,
+        }
+
+    def apply_damage(self, events):
+        ecsmanager = base.ecsmanager
+        for source, target, amount in events:
+            entity = ecsmanager.get_entity(target)
+            if entity is None or not entity.has_component('CHARACTER'):
+                continue
+            char = entity.get_component('CHARACTER')
+            was_alive = char.current_health > 0
+            char.current_health -= amount
+            char.start_recoil()
+            if was_alive and char.current_health <= 0:
+                ecsmanager.events.emit('DEATH', target, source)
+
+    def resolve_deaths(self, events):
+        # TODO make the player invincible for now
+        ecsmanager = base.ecsmanager
+        for target, source in events:
+            self.deaths += 1
+            entity = ecsmanager.get_entity(target)
+            if entity is None or entity.has_component('PLAYER'):
+                continue
+            if entity.has_component('PHY_HITBOX'):
+                entity.remove_component(entity.get_component('PHY_HITBOX'))
+            ecsmanager.remove_entity(entity)
+
+    def _attack_ray(self, nodepath):
+        to_vec = base.render.get_relative_vector(nodepath, p3d.LVector3f(0, 1, 0))
+        from_pos = nodepath.get_pos(base.render) + p3d.LVector3f(0, 0, 0.5)
+        return from_pos, from_pos + to_vec * self.attack_range
+
+    def _lag_compensated(self, player):
+        return player and player.view_time and base.ecsmanager.has_system('LagCompensationSystem')
+
+    def _targets_ahead(self, char, from_pos, to_pos):
+        # Skip the ray cast entirely when no other character is near the attack ray
+        if not base.ecsmanager.has_system('SpatialHashSystem'):
+            return True
+
+        spatial = base.ecsmanager.get_system('SpatialHashSystem')
+        return bool(spatial.characters_along(from_pos, to_pos, self.attack_corridor, exclude=char.entity.guid))
+
+    def _find_target(self, char, player, from_pos, to_pos):
+        # Returns (position, guid) of what the attack would hit, or None
+        physics = base.ecsmanager.get_system('PhysicsSystem')
+
+        if self._lag_compensated(player):
+            # Check against hitboxes where the attacker saw them, level geometry still blocks the attack
+            lagcomp = base.ecsmanager.get_system('LagCompensationSystem')
+            hit = lagcomp.ray_cast(from_pos, to_pos, player.view_time, exclude=char.entity.guid)
+            if hit is None:
+                return None
+            blockers = physics.ray_cast(from_pos, to_pos, mask=p3d.BitMask32.bit(GROUP_STATIC))
+            if blockers and blockers[0].t < hit[0]:
+                return None
+            return from_pos + (to_pos - from_pos) * hit[0], hit[1]
+
+        hits = physics.ray_cast(from_pos, to_pos, all_hits=True)
+        if not hits:
+            return None
+        hit = min(hits, key=lambda h: h.t)
+        return hit.position, hit.component.entity.guid
 
     def init_components(self, dt, components):
+        # Deferred so importing this module (e.g., for a headless server or bots) does not pull in direct.actor
+        from direct.actor.Actor import Actor
+
         #TODO: Component keys should always be in the dictionary
 
         for weapon in components.get('WEAPON', []):
-            weapon.actor = Actor('models/{}'.format(weapon.name))
+            if weapon.actor is None:
+                weapon.actor = Actor('models/{}'.format(weapon.name))
             np_component = weapon.entity.get_component('NODEPATH')
             weapon.actor.reparent_to(np_component.nodepath)
-
-        for char in components.get('CHARACTER', []):
-            self._attack_queues[char.entity.guid] = []
+            weapon.apply_pending()
 
         for comp in components.get('ACTOR', []):
-            path = 'models/{}/'.format(comp.name)
-            anim_files = [os.path.splitext(f)[0] for f in os.listdir(path) if f.endswith('.egg') and f != 'actor.egg']
-            anim_dict = {name: path + name for name in anim_files}
-            comp.actor = Actor(path + 'actor', anim_dict)
+            if comp.actor is None:
+                path = 'models/{}/'.format(comp.name)
+                anim_files = [os.path.splitext(f)[0] for f in os.listdir(path) if f.endswith('.egg') and f != 'actor.egg']
+                anim_dict = {name: path + name for name in anim_files}
+                comp.actor = Actor(path + 'actor', anim_dict)
             np_component = comp.entity.get_component('NODEPATH')
             comp.actor.reparent_to(np_component.nodepath)
+            comp.apply_pending()
 
     def update(self, dt, components):
-        for char in components['CHARACTER']:
-            nodepath = char.entity.get_component('NODEPATH').nodepath
-
-            actor = None
-            if char.entity.has_component('ACTOR'):
-                actor = char.entity.get_component('ACTOR').actor
-
-            if actor:
-                actor.disableBlend()
-                actor.pose('idle', 0)
+        events = base.ecsmanager.events
+        rows = base.ecsmanager.query(
+            ('CHARACTER', 'NODEPATH', 'PHY_CHARACTER'),
+            ('ACTOR', 'WEAPON', 'PLAYER'),
+        )
+        for char, np_comp, phys, actor_comp, weapon, player in rows:
+            nodepath = np_comp.nodepath
+            actor = actor_comp.actor if actor_comp else None
 
             # Position
             ms = char.move_speed * dt / 2
             char_speed = p3d.LVector3f(ms, 0, 0.0)
-            delta = char.movement
+            delta = p3d.LVector3f(char.movement)
             delta.componentwise_mult(char_speed)
-            phys = char.entity.get_component('PHY_CHARACTER')
-            phys.physics_node.set_linear_movement(delta, is_local=False)
+            phys.set_movement(delta)
             if char.movement.length_squared() > 0.0:
                 if char.movement.get_x() > 0:
                     nodepath.set_h(-90)
                 elif char.movement.get_x() < 0:
                     nodepath.set_h(90)
-                char.action_set.discard('ATTACK_MOVE')
+                char.actions &= ~Actions.ATTACK_MOVE
 
-            if 'JUMP' in char.action_set:
+            if char.actions & Actions.JUMP:
                 phys.physics_node.do_jump()
-                char.action_set.discard('JUMP')
-
-
-            # Resolve attacks
-            for attack in self._attack_queues[char.entity.guid]:
-                char.current_health -= attack.damage
-                char.recoil_timer = 0.0
-            self._attack_queues[char.entity.guid].clear()
-
-            if 'ATTACK' in char.action_set:
-                if base.ecsmanager.has_system('PhysicsSystem'):
-                    physics = base.ecsmanager.get_system('PhysicsSystem')
-                    to_vec = base.render.get_relative_vector(nodepath, p3d.LVector3f(0, 1, 0))
-                    from_pos = nodepath.get_pos() + p3d.LVector3f(0, 0, 0.5)
-                    to_pos = from_pos + to_vec * 1000
-                    hits = physics.ray_cast(from_pos, to_pos, all_hits=True)
-                    if hits:
-                        hit = min(hits, key=lambda h: h.t)
-                        char.attack_move_target = hit.position
-                        char.target_entity_guid = hit.component.entity.guid
-                        char.action_set.add('ATTACK_MOVE')
-
-                char.action_set.remove('ATTACK')
-
-            if 'ATTACK_MOVE' in char.action_set:
-                if char.entity.has_component('WEAPON'):
-                    weapon = char.entity.get_component('WEAPON')
+                char.actions &= ~Actions.JUMP
+
+            # Aborting has no effect yet, but the bits must not stick around
+            char.actions &= ~(Actions.ABORT_START | Actions.ABORT_END)
+
 
+            if char.actions & Actions.ATTACK:
+                # Lag compensated attacks test past positions, which lagcomp culls itself
+                from_pos, to_pos = self._attack_ray(nodepath)
+                if base.ecsmanager.has_system('PhysicsSystem') and (
+                    self._lag_compensated(player) or self._targets_ahead(char, from_pos, to_pos)
+                ):
+                    target = self._find_target(char, player, from_pos, to_pos)
+                    if target:
+                        char.attack_move_target, char.target_entity_guid = target
+                        char.actions |= Actions.ATTACK_MOVE
+
+                char.actions &= ~Actions.ATTACK
+
+            if char.actions & Actions.ATTACK_MOVE:
+                if weapon:
                     vec_to = char.attack_move_target - nodepath.get_pos()
                     distance = vec_to.length()
                     if distance < weapon.range:
@@ -299,56 +651,140 @@ class CharacterSystem(ecs.System):
                         if not anim_control.is_playing():
                             if weapon.has_hit:
                                 weapon.has_hit = False
-                                char.action_set.discard('ATTACK_MOVE')
+                                char.actions &= ~Actions.ATTACK_MOVE
                             else:
-                                weapon.actor.play('attack', fromFrame=1, toFrame=21)
+                                weapon.play('attack', fromFrame=1, toFrame=21)
 
                         if not weapon.has_hit and anim_control.get_frame() >= 18:
                             weapon.has_hit = True
-                            self._attack_queues[char.target_entity_guid].append(Attack(1))
+                            events.emit('HIT', char.entity.guid, char.target_entity_guid)
+                            events.emit('DAMAGE', char.entity.guid, char.target_entity_guid, self.attack_damage)
                     else:
                         vec_to.normalize()
                         vec_to.componentwiseMult(char_speed)
                         new_pos = nodepath.get_pos() + vec_to
                         nodepath.set_pos(new_pos)
 
-            for track in ['TRACK_ONE', 'TRACK_TWO', 'TRACK_THREE', 'TRACK_FOUR']:
-                if track in char.action_set:
-                    for component in getattr(char, track.lower()).get_components('EFFECT'):
+            for track, track_attr in Actions.TRACKS:
+                if char.actions & track:
+                    for component in getattr(char, track_attr).get_components('EFFECT'):
                         component.cmd_queue.add('ACTIVATE')
-                    char.action_set.remove(track)
-
-            # Resolve health and dying
-            # TODO make the player invincible for now
-            if char.current_health <= 0 and not char.entity.has_component('PLAYER'):
-                char.entity.remove_component(char.entity.get_component('PHY_HITBOX'))
-                base.ecsmanager.remove_entity(char.entity)
-
-            # Resolve recoil
-            if char.recoil_timer < char.recoil_duration:
-                char.recoil_timer += dt
+                    char.actions &= ~track
 
+            # Resolve recoil, the timer ends it
+            if char.recoil_timer is not None:
                 if actor:
-                    t = min(char.recoil_timer / char.recoil_duration, 1.0)
+                    t = min((base.ecsmanager.timers.time - char.recoil_start) / char.recoil_duration, 1.0)
                     mid_p = 0.33
                     if t > mid_p:
                         t = (t - mid_p) / (1.0 - mid_p)
                         t = 1.0 - t
                     else:
                         t /= mid_p
-                    actor.enableBlend()
-                    actor.setControlEffect('idle', 1 - t)
-                    actor.setControlEffect('hit', t)
-                    actor.pose('idle', 0)
-                    actor.pose('hit', 0)
+                    actor_comp.blend_poses({'idle': 1 - t, 'hit': t})
+            elif actor:
+                actor_comp.pose('idle', 0)
+
+
+class AnimationSystem(ecs.System):
+    # Animation LOD: actors nobody can see (off-screen, too far away or on a headless server) do not
+    # evaluate poses until they come back into view. Clients also nudge replicated animations back
+    # when they drift too far from the server.
+    component_types = [
+        'ACTOR',
+        'WEAPON',
+    ]
+
+    reads = ('ACTOR', 'WEAPON', 'NODEPATH')
+    writes = ('ACTOR', 'WEAPON')
+
+    def __init__(self):
+        super().__init__()
+        self.resync_interval = p3d.ConfigVariableDouble('anim-resync-interval', 0.5).get_value()
+        self.resync_frames = p3d.ConfigVariableDouble('anim-resync-frames', 2.0).get_value()
+        self.cull_interval = p3d.ConfigVariableDouble('anim-cull-interval', 0.2).get_value()
+        self.cull_distance = p3d.ConfigVariableDouble('anim-cull-distance', 60.0).get_value()
+        self.lod_near = p3d.ConfigVariableDouble('anim-lod-near-distance', 10.0).get_value()
+        self.lod_far = p3d.ConfigVariableDouble('anim-lod-far-distance', 40.0).get_value()
+        self.lod_delay = p3d.ConfigVariableDouble('anim-lod-delay-factor', 1.0).get_value()
+        self.resync_timer = 0.0
+        self.cull_timer = 0.0
+        self.resyncs = 0
+        self.culled = 0
+        self.poses_last_frame = 0
+        self.deferred_last_frame = 0
+
+    def init_components(self, dt, components):
+        for typeid in self.component_types:
+            for comp in components.get(typeid, []):
+                if comp.actor is None:
+                    continue
+                if base.win is None:
+                    # Nothing is rendered, but weapon animations still time attacks
+                    comp.set_anim_culled(typeid == 'ACTOR')
+                elif self.lod_far > 0:
+                    comp.actor.setLODAnimation(self.lod_far, self.lod_near, self.lod_delay)
+
+    def update(self, dt, components):
+        self.poses_last_frame = anim_counters['poses']
+        self.deferred_last_frame = anim_counters['deferred']
+        anim_counters.clear()
+
+        self.cull_timer += dt
+        if base.win is not None and self.cull_timer >= self.cull_interval:
+            self.cull_timer = 0.0
+            self.update_culling(components)
+
+        self.resync_timer += dt
+        if base.network_manager.netrole == 'SERVER' or self.resync_timer < self.resync_interval:
+            return
+        self.resync_timer = 0.0
+
+        now = base.network_manager.server_now()
+        for typeid in self.component_types:
+            for comp in components[typeid]:
+                if comp.anim_drift(now) > self.resync_frames:
+                    comp.apply_anim_state(now)
+                    self.resyncs += 1
+
+    def update_culling(self, components):
+        cull_distance_sq = self.cull_distance * self.cull_distance
+        culled = 0
+        for typeid in self.component_types:
+            for comp in components[typeid]:
+                if comp.actor is None:
+                    continue
+                pos = comp.actor.get_pos(base.cam)
+                is_culled = pos.length_squared() > cull_distance_sq or not base.camNode.is_in_view(pos)
+                comp.set_anim_culled(is_culled)
+                culled += is_culled
+        self.culled = culled
+
+    def diagnostics(self):
+        return {
+            'resyncs': self.resyncs,
+            'culled': self.culled,
+            'poses_last_frame': self.poses_last_frame,
+            'deferred_last_frame': self.deferred_last_frame,
+        }
 
 
 class AiComponent(ecs.UniqueComponent):
     __slots__ = [
-
+        'think_timer',
+        'think_interval',
     ]
 
     typeid = 'AI'
+    poolable = True
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        self.think_timer = 0.0
+        self.think_interval = 0.0
 
 
 class AiSystem(ecs.System):
@@ -357,22 +793,95 @@ class AiSystem(ecs.System):
         'AI',
     ]
 
+    reads = ('PLAYER', 'AI', 'CHARACTER', 'NODEPATH', 'SPATIAL_HASH')
+    writes = ('AI', 'CHARACTER', 'NODEPATH')
+    uses_components = False
+
+    def __init__(self):
+        super().__init__()
+        self.max_thinks_per_tick = p3d.ConfigVariableInt('ai-max-thinks-per-tick', 16).get_value()
+        self.think_budget = p3d.ConfigVariableDouble('ai-think-budget-ms', 2.0).get_value() / 1000.0
+
+        # (max distance, think interval) pairs, the last entry is used for anything further away
+        self.lod_levels = [
+            (p3d.ConfigVariableDouble('ai-lod-near-distance', 15.0).get_value(),
+             p3d.ConfigVariableDouble('ai-lod-near-interval', 0.1).get_value()),
+            (p3d.ConfigVariableDouble('ai-lod-mid-distance', 40.0).get_value(),
+             p3d.ConfigVariableDouble('ai-lod-mid-interval', 0.25).get_value()),
+            (float('inf'),
+             p3d.ConfigVariableDouble('ai-lod-far-interval', 1.0).get_value()),
+        ]
+
+        # Raised by the overload governor to stretch every think interval
+        self.think_scale = 1.0
+
+        self.thinks_last_tick = 0
+        self.deferred_last_tick = 0
+
+    def _think_interval(self, distance):
+        for max_distance, interval in self.lod_levels:
+            if distance <= max_distance:
+                return interval
+        return self.lod_levels[-1][1]
+
     def update(self, dt, components):
-        for aicomp in components['AI']:
-            # Pick target
-            try:
-                target = components['PLAYER'][0]
-            except IndexError:
-                continue
+        spatial = None
+        if base.ecsmanager.has_system('SpatialHashSystem'):
+            spatial = base.ecsmanager.get_system('SpatialHashSystem')
+
+        # Gather AI that are due to think, most overdue first
+        due = []
+        for row in base.ecsmanager.query(('AI', 'CHARACTER', 'NODEPATH')):
+            aicomp = row[0]
+            aicomp.think_timer += dt
+            think_interval = aicomp.think_interval * self.think_scale
+            if aicomp.think_timer >= think_interval:
+                overdue = aicomp.think_timer / think_interval if think_interval else float('inf')
+                due.append((overdue, row))
+        due.sort(key=lambda i: i[0], reverse=True)
+
+        start_time = globalClock.get_real_time()
+        thinks = 0
+        for _, row in due:
+            if thinks >= self.max_thinks_per_tick:
+                break
+            if thinks and globalClock.get_real_time() - start_time >= self.think_budget:
+                break
+
+            self.think(row, spatial)
+            row[0].think_timer = 0.0
+            thinks += 1
+
+        self.thinks_last_tick = thinks
+        self.deferred_last_tick = len(due) - thinks
+
+    def think(self, row, spatial):
+        aicomp, aichar, ainp = row
+        pos = ainp.nodepath.get_pos(base.render)
+
+        # Pick target
+        if spatial:
+            target = spatial.nearest_player(pos, exclude=aicomp.entity.guid)
+            if target is None:
+                aicomp.think_interval = self.lod_levels[-1][1]
+                return
+        else:
+            players = base.ecsmanager.query(('PLAYER',))
+            if not players:
+                aicomp.think_interval = self.lod_levels[-1][1]
+                return
+            target = players[0][0]
+
+        targetnp = target.entity.get_component('NODEPATH').nodepath
 
-            targetnp = target.entity.get_component('NODEPATH').nodepath
+        # Think less often about far away targets
+        distance = (targetnp.get_pos(base.render) - pos).length()
+        aicomp.think_interval = self._think_interval(distance)
 
-            # Face target
-            ainp = aicomp.entity.get_component('NODEPATH')
-            look_point = targetnp.get_pos()
-            look_point.z = ainp.nodepath.get_pos().z
-            ainp.nodepath.look_at(look_point, p3d.LVector3(0, 0, 1))
+        # Face target
+        look_point = targetnp.get_pos()
+        look_point.z = ainp.nodepath.get_pos().z
+        ainp.nodepath.look_at(look_point, p3d.LVector3(0, 0, 1))
 
-            # Attack target
-            aichar = aicomp.entity.get_component('CHARACTER')
-            aichar.action_set.add('ATTACK')
+        # Attack target
+        aichar.actions |= Actions.ATTACK
@@ -0,0 +1,96 @@
+import json
+import os
+import struct
+import zlib
+
+import ecs
+
+
+# A snapshot is a fixed header followed by a zlib compressed body of (netid, length, payload) records,
+# where each payload is the compact JSON of Entity.snapshot()
+MAGIC = b'SGSN'
+VERSION = 3
+_HEADER = struct.Struct('<4sHII')
+_RECORD = struct.Struct('<II')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def capture(ecsmanager, next_netid=0):
+    entities = [i for i in ecsmanager.entities if i.netid != 0]
+
+    body = bytearray()
+    for entity in entities:
+        payload = json.dumps(entity.snapshot(), separators=(',', ':')).encode('utf-8')
+        body += _RECORD.pack(entity.netid, len(payload))
+        body += payload
+
+    return _HEADER.pack(MAGIC, VERSION, next_netid, len(entities)) + zlib.compress(bytes(body))
+
+
+def _read_records(data):
+    if len(data) < _HEADER.size:
+        raise SnapshotError('Snapshot is truncated')
+
+    magic, version, next_netid, count = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError('Not a snapshot')
+    if version != VERSION:
+        raise SnapshotError('Unsupported snapshot version {}'.format(version))
+
+    body = zlib.decompress(data[_HEADER.size:])
+    records = []
+    offset = 0
+    for _ in range(count):
+        netid, length = _RECORD.unpack_from(body, offset)
+        offset += _RECORD.size
+        records.append((netid, json.loads(body[offset:offset + length].decode('utf-8'))))
+        offset += length
+
+    return next_netid, records
+
+
+def restore(ecsmanager, data, skip=None):
+    # Entities are matched by netid: existing ones are reset in place (keeping their scene and
+    # physics nodes), missing ones are recreated and networked entities not in the snapshot are removed.
+    # Records for which skip(netid, components) is true are treated as missing from the snapshot.
+    # Returns the next_netid stored in the snapshot.
+    next_netid, records = _read_records(data)
+
+    existing = {i.netid: i for i in ecsmanager.entities if i.netid != 0}
+    for netid, components in records:
+        if skip is not None and skip(netid, components):
+            continue
+
+        entity = existing.pop(netid, None)
+        if entity is None:
+            entity = ecsmanager.create_entity()
+            entity.netid = netid
+            for typeid, clist in components.items():
+                for cdata in clist:
+                    cls = ecs.resolve_component_class(cdata['import_string'])
+                    entity.add_component(ecsmanager.acquire_component(cls, *cls.snapshot_args(cdata)))
+
+        for typeid, clist in components.items():
+            for component, cdata in zip(entity.get_components(typeid), clist):
+                component.restore(cdata)
+
+    for entity in existing.values():
+        ecsmanager.remove_entity(entity)
+
+    return next_netid
+
+
+def write(path, data):
+    # Write next to the target first so a crash mid-write never leaves a corrupt snapshot behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
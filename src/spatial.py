@@ -0,0 +1,246 @@
+from __future__ import division
+
+import math
+
+import ecs
+
+
+class SpatialHash(object):
+    __slots__ = [
+        'cell_size',
+        '_cells',
+        '_entries',
+    ]
+
+    def __init__(self, cell_size=4.0):
+        self.cell_size = cell_size
+        self._cells = {}
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _cell(self, pos):
+        inv = 1.0 / self.cell_size
+        return (
+            int(math.floor(pos[0] * inv)),
+            int(math.floor(pos[1] * inv)),
+            int(math.floor(pos[2] * inv)),
+        )
+
+    def insert(self, key, pos, value=None):
+        if key in self._entries:
+            self.update(key, pos)
+            return
+
+        cell = self._cell(pos)
+        self._entries[key] = [cell, (pos[0], pos[1], pos[2]), value]
+        self._cells.setdefault(cell, set()).add(key)
+
+    def update(self, key, pos):
+        entry = self._entries[key]
+        entry[1] = (pos[0], pos[1], pos[2])
+
+        # Only relink when the key crosses a cell boundary
+        cell = self._cell(pos)
+        if cell != entry[0]:
+            self._unlink(key, entry[0])
+            entry[0] = cell
+            self._cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        entry = self._entries.pop(key)
+        self._unlink(key, entry[0])
+
+    def _unlink(self, key, cell):
+        bucket = self._cells[cell]
+        bucket.discard(key)
+        if not bucket:
+            del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._entries.clear()
+
+    def position(self, key):
+        return self._entries[key][1]
+
+    def value(self, key):
+        return self._entries[key][2]
+
+    def within_radius(self, pos, radius, predicate=None):
+        # Returns (distance_squared, key, value) tuples
+        results = []
+        radius_sq = radius * radius
+        min_cell = self._cell((pos[0] - radius, pos[1] - radius, pos[2] - radius))
+        max_cell = self._cell((pos[0] + radius, pos[1] + radius, pos[2] + radius))
+
+        # Walk whichever is smaller: the covered cells or the occupied cells
+        num_covered = (
+            (max_cell[0] - min_cell[0] + 1) *
+            (max_cell[1] - min_cell[1] + 1) *
+            (max_cell[2] - min_cell[2] + 1)
+        )
+        if num_covered < len(self._cells):
+            cells = (
+                (x, y, z)
+                for x in range(min_cell[0], max_cell[0] + 1)
+                for y in range(min_cell[1], max_cell[1] + 1)
+                for z in range(min_cell[2], max_cell[2] + 1)
+            )
+        else:
+            cells = [
+                cell for cell in self._cells
+                if all(min_cell[i] <= cell[i] <= max_cell[i] for i in range(3))
+            ]
+
+        for cell in cells:
+            for key in self._cells.get(cell, ()):
+                _, epos, value = self._entries[key]
+                dx = epos[0] - pos[0]
+                dy = epos[1] - pos[1]
+                dz = epos[2] - pos[2]
+                dist_sq = dx * dx + dy * dy + dz * dz
+                if dist_sq <= radius_sq and (predicate is None or predicate(key, value)):
+                    results.append((dist_sq, key, value))
+
+        return results
+
+    def along_segment(self, from_pos, to_pos, radius, predicate=None):
+        # Returns (t, key, value) tuples for keys within radius of the segment, t runs from 0 to 1
+        delta = (to_pos[0] - from_pos[0], to_pos[1] - from_pos[1], to_pos[2] - from_pos[2])
+        length_sq = delta[0] * delta[0] + delta[1] * delta[1] + delta[2] * delta[2]
+        if length_sq == 0.0:
+            return [(0.0, key, value) for _, key, value in self.within_radius(from_pos, radius, predicate)]
+
+        # Sample the segment once per cell, anything near it is at most pad cells from a sample
+        steps = int(math.sqrt(length_sq) / self.cell_size) + 1
+        pad = int(math.ceil(radius / self.cell_size + 0.5))
+        if steps * (2 * pad + 1) ** 3 < len(self._cells):
+            cells = set()
+            for step in range(steps + 1):
+                t = step / steps
+                center = self._cell((
+                    from_pos[0] + delta[0] * t,
+                    from_pos[1] + delta[1] * t,
+                    from_pos[2] + delta[2] * t,
+                ))
+                cells.update(
+                    (center[0] + x, center[1] + y, center[2] + z)
+                    for x in range(-pad, pad + 1)
+                    for y in range(-pad, pad + 1)
+                    for z in range(-pad, pad + 1)
+                )
+        else:
+            min_cell = self._cell([min(from_pos[i], to_pos[i]) - radius for i in range(3)])
+            max_cell = self._cell([max(from_pos[i], to_pos[i]) + radius for i in range(3)])
+            cells = [
+                cell for cell in self._cells
+                if all(min_cell[i] <= cell[i] <= max_cell[i] for i in range(3))
+            ]
+
+        results = []
+        radius_sq = radius * radius
+        for cell in cells:
+            for key in self._cells.get(cell, ()):
+                _, epos, value = self._entries[key]
+                offset = (epos[0] - from_pos[0], epos[1] - from_pos[1], epos[2] - from_pos[2])
+                t = (offset[0] * delta[0] + offset[1] * delta[1] + offset[2] * delta[2]) / length_sq
+                t = min(max(t, 0.0), 1.0)
+                dx = offset[0] - delta[0] * t
+                dy = offset[1] - delta[1] * t
+                dz = offset[2] - delta[2] * t
+                if dx * dx + dy * dy + dz * dz <= radius_sq and (predicate is None or predicate(key, value)):
+                    results.append((t, key, value))
+
+        return results
+
+    def nearest(self, pos, max_radius=None, predicate=None):
+        if not self._entries:
+            return None
+
+        # Grow the search radius until something is found or every occupied cell is covered
+        limit = max_radius if max_radius is not None else self._extent(pos)
+        radius = min(self.cell_size, limit)
+        while True:
+            hits = self.within_radius(pos, radius, predicate)
+            if hits:
+                return min(hits, key=lambda hit: hit[0])
+            if radius >= limit:
+                return None
+            radius = min(radius * 2, limit)
+
+    def keys(self):
+        return self._entries.keys()
+
+    def _extent(self, pos):
+        extent = [0.0, 0.0, 0.0]
+        for cell in self._cells:
+            for i in range(3):
+                lower = cell[i] * self.cell_size
+                extent[i] = max(extent[i], abs(lower - pos[i]), abs(lower + self.cell_size - pos[i]))
+        return math.sqrt(sum(i * i for i in extent))
+
+
+class SpatialHashSystem(ecs.System):
+    # Characters are only re-hashed when their node moved. Panda caches net transforms and shares
+    # equal states, so an unmoved character costs one pointer comparison.
+    __slots__ = [
+        'characters',
+        '_transforms',
+    ]
+
+    component_types = [
+        'CHARACTER',
+    ]
+
+    reads = ('CHARACTER', 'NODEPATH', 'PLAYER')
+    writes = ('SPATIAL_HASH',)
+    uses_components = False
+
+    def __init__(self, cell_size=4.0):
+        super().__init__()
+        self.characters = SpatialHash(cell_size)
+        self._transforms = {}
+
+    def update(self, dt, components):
+        transforms = self._transforms
+        for char, np_comp in base.ecsmanager.query(('CHARACTER', 'NODEPATH')):
+            guid = char.entity.guid
+            net_transform = np_comp.nodepath.get_net_transform()
+            last = transforms.get(guid)
+            if net_transform == last:
+                continue
+
+            transforms[guid] = net_transform
+            if last is None:
+                self.characters.insert(guid, net_transform.get_pos(), char)
+            else:
+                self.characters.update(guid, net_transform.get_pos())
+
+    def entity_destroyed(self, entity):
+        if entity.guid in self.characters:
+            self.characters.remove(entity.guid)
+        self._transforms.pop(entity.guid, None)
+
+    def diagnostics(self):
+        return {
+            'indexed_characters': len(self.characters),
+        }
+
+    def nearest_player(self, pos, max_radius=None, exclude=None):
+        def is_player(guid, char):
+            return guid != exclude and char.entity is not None and char.entity.has_component('PLAYER')
+        hit = self.characters.nearest(pos, max_radius, is_player)
+        return hit[2] if hit else None
+
+    def characters_in_radius(self, pos, radius, exclude=None):
+        hits = self.characters.within_radius(pos, radius, lambda guid, char: guid != exclude)
+        return [hit[2] for hit in sorted(hits, key=lambda hit: hit[0])]
+
+    def characters_along(self, from_pos, to_pos, radius, exclude=None):
+        hits = self.characters.along_segment(from_pos, to_pos, radius, lambda guid, char: guid != exclude)
+        return [hit[2] for hit in sorted(hits, key=lambda hit: hit[0])]
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+import argparse
+import json
+import math
+import os
+
+import panda3d.core as p3d
+
+import ecs
+from physics import StaticPhysicsMeshComponent
+from player import NodePathComponent
+
+
+# Levels can be split into chunks offline (run this module), a chunked level is a directory next to
+# the level model holding one bam per chunk and an index with each chunk's bounds
+INDEX_VERSION = 1
+
+
+def chunk_dir(level):
+    return level + '_chunks'
+
+
+def has_chunks(level):
+    return os.path.exists(os.path.join(chunk_dir(level), 'index.json'))
+
+
+def build_chunks(level, chunk_size):
+    loader = p3d.Loader.get_global_ptr()
+    root = p3d.NodePath(loader.load_sync(p3d.Filename.from_os_specific(level + '.egg')))
+
+    start_positions = []
+    for psn in root.find_all_matches('**/playerstart;+h-s+i'):
+        start_positions.append(list(psn.get_pos(root)))
+        psn.remove_node()
+
+    # Group geometry by the cell its center falls in, big pieces stay whole and just widen their chunk
+    chunks = {}
+    for geom_np in root.find_all_matches('**/+GeomNode'):
+        bounds = geom_np.get_tight_bounds(root)
+        if not bounds:
+            continue
+        center = (bounds[0] + bounds[1]) / 2
+        key = '{},{}'.format(math.floor(center.x / chunk_size), math.floor(center.y / chunk_size))
+        if key not in chunks:
+            chunks[key] = p3d.NodePath('chunk {}'.format(key))
+        geom_np.wrt_reparent_to(chunks[key])
+
+    output_dir = chunk_dir(level)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    index = {
+        'version': INDEX_VERSION,
+        'chunk_size': chunk_size,
+        'start_positions': start_positions,
+        'chunks': {},
+    }
+    for key, chunk in sorted(chunks.items()):
+        chunk.flatten_strong()
+        bounds_min, bounds_max = chunk.get_tight_bounds()
+        filename = 'chunk_{}.bam'.format(key.replace(',', '_'))
+        chunk.write_bam_file(p3d.Filename.from_os_specific(os.path.join(output_dir, filename)))
+        index['chunks'][key] = {
+            'file': filename,
+            'bounds': list(bounds_min) + list(bounds_max),
+        }
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+    return index
+
+
+class ChunkIndex(object):
+    def __init__(self, level):
+        self.path = chunk_dir(level)
+        with open(os.path.join(self.path, 'index.json')) as f:
+            data = json.load(f)
+        if data['version'] != INDEX_VERSION:
+            raise RuntimeError('Unsupported level chunk index version {}'.format(data['version']))
+
+        self.chunk_size = data['chunk_size']
+        self.start_positions = [p3d.LVector3f(*i) for i in data['start_positions']]
+        self.chunks = {key: tuple(chunk['bounds']) for key, chunk in data['chunks'].items()}
+        self.files = {key: os.path.join(self.path, chunk['file']) for key, chunk in data['chunks'].items()}
+
+    def chunks_near(self, positions, radius):
+        # Keys of every chunk whose bounds come within radius of any of the positions
+        keys = set()
+        for key, bounds in self.chunks.items():
+            for pos in positions:
+                if (bounds[0] - radius <= pos[0] <= bounds[3] + radius and
+                        bounds[1] - radius <= pos[1] <= bounds[4] + radius and
+                        bounds[2] - radius <= pos[2] <= bounds[5] + radius):
+                    keys.add(key)
+                    break
+        return keys
+
+
+class ChunkedLevelData(object):
+    # Stands in for LevelData, geometry is loaded by the LevelStreamingSystem instead of up front
+    def __init__(self, level, parent):
+        self.index = ChunkIndex(level)
+        self.start_positions = list(self.index.start_positions)
+        if not self.start_positions:
+            print('Warning: No player start, adding (0, 0, 0)')
+            self.start_positions.append(p3d.LVector3f(0, 0, 0))
+
+        if base.ecsmanager.has_system('LevelStreamingSystem'):
+            streaming = base.ecsmanager.get_system('LevelStreamingSystem')
+            streaming.set_index(self.index)
+            streaming.load_around(self.start_positions)
+
+
+class LevelStreamingSystem(ecs.System):
+    # Servers keep collision for chunks near characters, clients keep render geometry around the local player
+    component_types = []
+
+    reads = ('CHARACTER', 'NODEPATH', 'LEVEL')
+    writes = ('LEVEL', 'ENTITIES')
+
+    def __init__(self, is_server):
+        super().__init__()
+        self.is_server = is_server
+        self.index = None
+        self.loaded = {}
+        self.last_wanted = {}
+        self._chunk_keys = {}
+        self.stream_interval = p3d.ConfigVariableDouble('level-stream-interval', 0.1).get_value()
+        self.unload_delay = p3d.ConfigVariableDouble('level-chunk-unload-delay', 2.0).get_value()
+        if is_server:
+            self.radius = p3d.ConfigVariableDouble('level-collision-margin', 4.0).get_value()
+        else:
+            self.radius = p3d.ConfigVariableDouble('level-stream-radius', 40.0).get_value()
+        self.timer = 0.0
+        self.loads = 0
+        self.unloads = 0
+
+    def set_index(self, index):
+        self.index = index
+        self.loaded.clear()
+        self.last_wanted.clear()
+        self._chunk_keys.clear()
+        self.timer = self.stream_interval
+
+    def _positions(self):
+        if self.is_server:
+            return [
+                np_comp.nodepath.get_pos(base.render)
+                for char, np_comp in base.ecsmanager.query(('CHARACTER', 'NODEPATH'))
+            ]
+
+        player = base.game_mode.player
+        if player is None or not player.has_component('NODEPATH'):
+            return []
+        return [player.get_component('NODEPATH').nodepath.get_pos(base.render)]
+
+    def update(self, dt, components):
+        if self.index is None:
+            return
+
+        self.timer += dt
+        if self.timer < self.stream_interval:
+            return
+        now = globalClock.get_frame_time()
+        self.timer = 0.0
+
+        self._want(self.index.chunks_near(self._positions(), self.radius), now)
+
+        for key in [i for i in self.loaded if now - self.last_wanted[i] > self.unload_delay]:
+            entity = self.loaded.pop(key)
+            del self.last_wanted[key]
+            del self._chunk_keys[entity.guid]
+            base.ecsmanager.remove_entity(entity)
+            self.unloads += 1
+
+    def _want(self, keys, now):
+        for key in keys:
+            self.last_wanted[key] = now
+            if key not in self.loaded:
+                entity = self.load_chunk(key)
+                self.loaded[key] = entity
+                self._chunk_keys[entity.guid] = key
+
+    def load_around(self, positions):
+        # Loads chunks right away instead of on the next stream interval, so ground is there before
+        # anything spawns on it
+        if self.index is not None:
+            self._want(self.index.chunks_near(positions, self.radius), globalClock.get_frame_time())
+
+    def load_chunk(self, key):
+        spacenp = base.ecsmanager.space.get_component('NODEPATH').nodepath
+        entity = base.ecsmanager.create_entity()
+        if self.is_server:
+            # Only the collision meshes are kept, the render geometry is dropped once they are built
+            model = base.loader.load_model(self.index.files[key], noCache=True)
+            np_component = base.ecsmanager.acquire_component(NodePathComponent)
+            entity.add_component(np_component)
+            for geom_node in model.find_all_matches('**/+GeomNode'):
+                entity.add_component(StaticPhysicsMeshComponent(geom_node, geom_node.get_pos()))
+            model.remove_node()
+        else:
+            np_component = NodePathComponent(self.index.files[key])
+            entity.add_component(np_component)
+        np_component.nodepath.reparent_to(spacenp)
+
+        self.loads += 1
+        return entity
+
+    def entity_destroyed(self, entity):
+        # Chunks are also removed with the rest of the space when a game ends
+        key = self._chunk_keys.pop(entity.guid, None)
+        if key is not None:
+            del self.loaded[key]
+            del self.last_wanted[key]
+
+    def diagnostics(self):
+        return {
+            'chunks': len(self.index.chunks) if self.index else 0,
+            'loaded_chunks': len(self.loaded),
+            'chunk_loads': self.loads,
+            'chunk_unloads': self.unloads,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split a level model into streamable chunks')
+    parser.add_argument('level', help='level model path without extension, e.g. models/level2d')
+    parser.add_argument('--chunk-size', type=float, default=32.0)
+    args = parser.parse_args()
+
+    index = build_chunks(args.level, args.chunk_size)
+    print('Wrote {} chunks to {}'.format(len(index['chunks']), chunk_dir(args.level)))